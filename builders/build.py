@@ -12,19 +12,18 @@ import os
 if os.path.dirname(__file__) not in sys.path:
     sys.path.append(os.path.dirname(__file__))
 
-from build_util import get_module
+from build_util import get_module, LazyRegistry
+
+def get_variant(name):
+    try:
+        return get_module('variants.'+name)
+    except Exception:
+        print('failed to import variants.'+name)
+        raise
 
 def get_variants():
-    build_variants = {}
-    for module in os.listdir(os.path.join(os.path.dirname(__file__),'variants')):
-        if module.endswith('.py') and module != '__init__.py':
-            tmp = os.path.splitext(module)[0]
-            try:
-                build_variants[tmp] = get_module('variants.'+tmp)
-            except Exception:
-                print('failed to import variants.'+tmp)
-                raise
-    return build_variants
+    """Get all variants, importing each on first access"""
+    return LazyRegistry('variants', get_variant)
 
 def absolute(p):
     return os.path.abspath(os.path.expandvars(os.path.expanduser(p)))
@@ -49,6 +48,8 @@ def main():
                       help="Skip build, only do SVN {True,False}")
     parser.add_option("--nightly", action="store_true", default=False, 
                       help="This is a nightly build")
+    parser.add_option("--download-cache", type="string", default=None,
+                      help="Download cache directory, shared between builds")
     parser.add_option('--debug', default=False, action='store_true')
     
     (options, args) = parser.parse_args()
@@ -63,6 +64,8 @@ def main():
         os.environ['TMPDIR'] = options.scratch
         os.environ['TEMP'] = options.scratch
         os.environ['TMP'] = options.scratch
+    if options.download_cache:
+        os.environ['DOWNLOAD_CACHE'] = absolute(options.download_cache)
     
     kwargs = {}
     if options.svnup and options.svnup.lower() in ('1','true','on','yes','y','t'):
@@ -4,7 +4,7 @@ import os
 import subprocess
 import shutil
 from functools import partial
-from collections import Iterable
+from collections import Iterable, Mapping
 
 if 'CPUS' in os.environ:
     cpu_cores = os.environ['CPUS']
@@ -20,22 +20,230 @@ def get_module(name, class_name='build'):
     x = __import__(name,globals(),locals(),[class_name])
     return (getattr(x,class_name))
 
+class LazyRegistry(Mapping):
+    """
+    Mapping of the modules in a package, loaded on first access.
+
+    The index of module names is read once from the package directory.
+    A module is only imported, and passed through `loader`, the first
+    time its name is looked up.
+
+    Args:
+        package (str): package directory name, next to this file
+        loader (callable): loader(name) returns the value for a module
+    """
+    def __init__(self, package, loader):
+        self.package = package
+        self.loader = loader
+        self.loaded = {}
+        self._index = None
+
+    @property
+    def index(self):
+        """Sorted list of module names in the package"""
+        if self._index is None:
+            root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),self.package)
+            names = []
+            for module in os.listdir(root_dir):
+                if module.startswith('.'):
+                    continue
+                if module.endswith('.py') and module != '__init__.py':
+                    names.append(os.path.splitext(module)[0])
+                elif os.path.isfile(os.path.join(root_dir,module,'__init__.py')):
+                    names.append(module)
+            self._index = sorted(names)
+        return self._index
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            if name not in self.index:
+                raise KeyError(name)
+            self.loaded[name] = self.loader(name)
+        return self.loaded[name]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+_tools = LazyRegistry('tools', lambda name: get_module('tools.'+name,'versions')())
+
 def get_tools():
-    """Get all tools, calling the `versions` function"""
-    root_dir = os.path.join(os.path.dirname(__file__),'tools')
-    tools = {}
-    for module in os.listdir(root_dir):
-        if module.startswith('.'):
-            continue
-        if module.endswith('.py') and module != '__init__.py':
-            tmp = os.path.splitext(module)[0]
-            tools[tmp] = get_module('tools.'+tmp,'versions')()
-        elif os.path.isdir(os.path.join(root_dir,module)):
-            tools[module] = get_module('tools.'+module,'versions')()
-    return tools
-
-def wget(src, dest, retry=1):
+    """Get all tools, calling the `versions` function on first access"""
+    return _tools
+
+def get_download_cache():
+    """Get the download cache directory, from $DOWNLOAD_CACHE"""
+    return os.environ.get('DOWNLOAD_CACHE',None)
+
+def _file_hashes(path):
+    """Get the md5 and sha256 hex digests of a file"""
+    import hashlib
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    filed = open(path,'rb')
+    buffer = filed.read(1048576)
+    while buffer:
+        md5.update(buffer)
+        sha256.update(buffer)
+        buffer = filed.read(1048576)
+    filed.close()
+    return {'md5':md5.hexdigest(),'sha256':sha256.hexdigest()}
+
+def _check_hashes(hashes,checksum=None,md5sum=None,name=''):
+    """Check a md5 or sha256 checksum, and a md5sum (file), against file hashes"""
+    if checksum and checksum.lower() not in hashes.values():
+        raise Exception('checksum doesn\'t match: expected %s, got %r'%(checksum,hashes))
+    if md5sum:
+        _match_md5sum(name,hashes['md5'],md5sum)
+
+class DownloadCache(object):
+    """
+    Content-addressed cache of downloaded files.
+
+    Entries are keyed by the sha256 of the url (and checksum, if any).
+    Each entry has a json manifest with the size and hashes, written
+    once when the download is verified.  Downloads resume from a
+    `.part` file under a lock, then are renamed into place, so several
+    builders can share the cache on a shared filesystem.
+
+    Args:
+        path (str): cache directory
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def entry(self, url, checksum=None):
+        """Get the path of the cache entry for a url"""
+        import hashlib
+        key = url if not checksum else url+'\n'+checksum.lower()
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path,key[:2],key)
+
+    def lookup(self, url, checksum=None, md5sum=None):
+        """
+        Get the cached file for a url, or None.
+
+        The file is checked against its manifest, so an entry that no
+        longer matches the md5sum (file) is not returned.
+        """
+        import json
+        path = self.entry(url,checksum)
+        try:
+            manifest = json.load(open(path+'.json'))
+            if os.path.getsize(path) == manifest['size']:
+                _check_hashes(manifest,checksum,md5sum,url.rsplit('/',1)[-1])
+                return path
+        except Exception:
+            pass
+        return None
+
+    def remove(self, url, checksum=None):
+        """Remove the cache entry for a url, if there is one"""
+        path = self.entry(url,checksum)
+        for p in (path+'.json',path):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def add(self, url, part, checksum=None, hashes=None, md5sum=None):
+        """
+        Verify a complete download and move it into the cache.
+
+        Args:
+            url (str): url of the download
+            part (str): the downloaded file, on the cache filesystem
+            checksum (str): md5 or sha256 to verify (optional)
+            hashes (dict): md5 and sha256 of part, if already known
+            md5sum (str): md5, or a md5sum file listing the url (optional)
+        Returns:
+            str: path of the cached file
+        """
+        import json
+        path = self.entry(url,checksum)
+        if not hashes:
+            hashes = _file_hashes(part)
+        try:
+            _check_hashes(hashes,checksum,md5sum,url.rsplit('/',1)[-1])
+        except Exception:
+            os.remove(part)
+            raise
+        manifest = {'url':url,'size':os.path.getsize(part)}
+        manifest.update(hashes)
+        os.rename(part,path)
+        with open(path+'.json.tmp','w') as f:
+            json.dump(manifest,f)
+        os.rename(path+'.json.tmp',path+'.json')
+        return path
+
+    def locked(self, url, checksum=None):
+        """Open and lock the cache entry for a url, returning the lock file"""
+        import fcntl
+        path = self.entry(url,checksum)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except Exception:
+            pass
+        lock = open(path+'.lock','a')
+        fcntl.lockf(lock,fcntl.LOCK_EX)
+        return lock
+
+    def fetch(self, url, checksum=None, md5sum=None):
+        """
+        Get the cached file for a url, downloading it if needed.
+
+        A cached file that fails the checksum or md5sum (file) is stale,
+        and is removed and downloaded again.
+        """
+        path = self.lookup(url,checksum,md5sum)
+        if path:
+            return path
+        lock = self.locked(url,checksum)
+        try:
+            # another builder may have finished while we waited
+            path = self.lookup(url,checksum,md5sum)
+            if path:
+                return path
+            self.remove(url,checksum)
+            part = self.entry(url,checksum)+'.part'
+            subprocess.check_call(['wget','-nv','-c','-t','5','-T','5','-O',part,url])
+            return self.add(url,part,checksum,md5sum=md5sum)
+        finally:
+            lock.close()
+
+def link_or_copy(src, dest):
+    """Hard link src to dest, copying if that is not possible"""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src,dest)
+    except OSError:
+        shutil.copy2(src,dest)
+
+def wget(src, dest, retry=1, checksum=None, md5sum=None, cache=True):
+    """
+    Download a url to dest.
+
+    With $DOWNLOAD_CACHE set, the file is fetched through the download
+    cache.  Use `cache=False` for urls whose contents change.
+
+    Args:
+        src (str): url
+        dest (str): destination file
+        checksum (str): md5 or sha256 to verify (optional)
+        md5sum (str): md5, or a md5sum file listing the url (optional)
+        cache (bool): use the download cache (default True)
+    """
+    cache_dir = get_download_cache()
+    if cache and cache_dir:
+        link_or_copy(DownloadCache(cache_dir).fetch(src,checksum,md5sum),dest)
+        return
     subprocess.check_call(['wget','-nv','-t','5','-T','5','-O',dest,src])
+    if checksum or md5sum:
+        _check_hashes(_file_hashes(dest),checksum,md5sum,src.rsplit('/',1)[-1])
 
 def wget_recursive(src, dest):
     subprocess.check_call(['wget','-nv','-N','-t','5','-P',dest,'-r','-l','1','-A','*.i3*','-nd',src])
@@ -83,17 +291,15 @@ def get_md5sum(path):
         import md5
         digest = md5.new()
 
-    filed = open(path)
-    buffer = filed.read(16384)
+    filed = open(path,'rb')
+    buffer = filed.read(1048576)
     while buffer:
         digest.update(buffer)
-        buffer = filed.read(16384)
+        buffer = filed.read(1048576)
     filed.close()
     return digest.hexdigest()
 
-def check_md5sum(path,md5sum=''):
-    name = os.path.basename(path)
-    cur_sum = get_md5sum(path)
+def _match_md5sum(name,cur_sum,md5sum=''):
     if cur_sum == md5sum:
         return
     if os.path.exists(md5sum):
@@ -105,20 +311,221 @@ def check_md5sum(path,md5sum=''):
                     return
     raise Exception('md5sum doesn\'t match')
 
-def copy_src(src,dest):
-    """Copy anything from src to dest"""
+def check_md5sum(path,md5sum=''):
+    _match_md5sum(os.path.basename(path),get_md5sum(path),md5sum)
+
+def _stream_download(url, part=None):
+    """
+    Yield the bytes of a download, in 1 MiB chunks.
+
+    With a part file, the download resumes into it with `wget -c`.
+    The bytes already in the part file are yielded first, then the
+    new bytes as wget writes them.
+    """
+    import time
+    if not part:
+        fetch = subprocess.Popen(['wget','-nv','-t','5','-T','5','-O','-',url],stdout=subprocess.PIPE)
+        try:
+            buffer = fetch.stdout.read(1048576)
+            while buffer:
+                yield buffer
+                buffer = fetch.stdout.read(1048576)
+        finally:
+            fetch.stdout.close()
+            fetch.wait()
+        if fetch.returncode:
+            raise Exception('failed to download '+url)
+        return
+    open(part,'ab').close()
+    fetch = subprocess.Popen(['wget','-nv','-c','-t','5','-T','5','-O',part,url])
+    filed = open(part,'rb')
+    try:
+        while True:
+            done = fetch.poll() is not None
+            buffer = filed.read(1048576)
+            if buffer:
+                yield buffer
+            elif done:
+                break
+            else:
+                time.sleep(0.1)
+    finally:
+        filed.close()
+        if fetch.poll() is None:
+            fetch.kill()
+            fetch.wait()
+    if fetch.returncode:
+        raise Exception('failed to download '+url)
+
+def fetch_unpack(url, dest, flags=['-zx'], checksum=None, md5sum=None, cache=True):
+    """
+    Download and unpack a tarball in one pass.
+
+    The download is streamed through md5 and sha256 hashing into a
+    `tar` pipe.  With a download cache, it is written to the cache
+    entry's part file and read back as it arrives, so a partial
+    download from an earlier attempt is resumed.  It is unpacked into
+    a staging dir in dest, and only moved into place once the checksum
+    matches.  A cached archive is unpacked directly.
+
+    Args:
+        url (str): url of the tarball
+        dest (str): directory to unpack into
+        flags (list): tar flags (default ['-zx'])
+        checksum (str): md5 or sha256 to verify (optional)
+        md5sum (str): md5, or a md5sum file listing the tarball (optional)
+        cache (bool): use the download cache (default True)
+    """
+    import hashlib
+    import tempfile
+    cache_dir = get_download_cache()
+    download_cache = DownloadCache(cache_dir) if cache and cache_dir else None
+    staging = tempfile.mkdtemp(dir=dest,prefix='.unpack-')
+    lock = None
+    try:
+        cached = download_cache.lookup(url,checksum,md5sum) if download_cache else None
+        if download_cache and not cached:
+            lock = download_cache.locked(url,checksum)
+            # another builder may have finished while we waited
+            cached = download_cache.lookup(url,checksum,md5sum)
+        if cached:
+            unpack(cached,staging,flags=flags)
+        else:
+            part = None
+            if download_cache:
+                # remove a stale entry that fails the checksum
+                download_cache.remove(url,checksum)
+                part = download_cache.entry(url,checksum)+'.part'
+            md5 = hashlib.md5()
+            sha256 = hashlib.sha256()
+            tar = subprocess.Popen(['tar']+flags+['-f','-','-C',staging],stdin=subprocess.PIPE)
+            chunks = _stream_download(url,part)
+            downloaded = False
+            bad = False
+            try:
+                try:
+                    for buffer in chunks:
+                        md5.update(buffer)
+                        sha256.update(buffer)
+                        try:
+                            tar.stdin.write(buffer)
+                        except (IOError,OSError):
+                            bad = True
+                            raise
+                    downloaded = True
+                finally:
+                    chunks.close()
+                    tar.stdin.close()
+                if tar.wait():
+                    raise Exception('failed to unpack '+url)
+                hashes = {'md5':md5.hexdigest(),'sha256':sha256.hexdigest()}
+                _check_hashes(hashes,checksum,md5sum,url.rsplit('/',1)[-1])
+            except Exception:
+                tar.wait()
+                # keep a partial download to resume, unless it is bad
+                if part and os.path.exists(part) and (downloaded or bad):
+                    os.remove(part)
+                raise
+            if download_cache:
+                download_cache.add(url,part,checksum,hashes=hashes)
+        for name in os.listdir(staging):
+            path = os.path.join(dest,name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+            os.rename(os.path.join(staging,name),path)
+    finally:
+        if lock:
+            lock.close()
+        shutil.rmtree(staging)
+
+def _file_digest(path):
+    import hashlib
+    digest = hashlib.sha256()
+    filed = open(path,'rb')
+    buffer = filed.read(1048576)
+    while buffer:
+        digest.update(buffer)
+        buffer = filed.read(1048576)
+    filed.close()
+    return digest.digest()
+
+def _list_tree(path):
+    """List files under path, relative to it, skipping hidden files"""
+    ret = set()
+    for root,dirs,files in os.walk(path,followlinks=True):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+        rel = os.path.relpath(root,path)
+        for name in files:
+            if not name.startswith('.') and not name.endswith('.pyc'):
+                ret.add(os.path.normpath(os.path.join(rel,name)))
+    return ret
+
+def sync_tree(src,dest,delete=False,workers=8):
+    """
+    Sync files from src to dest, copying only what changed.
+
+    A file is unchanged if the size and mtime match, or failing that,
+    if the contents match.  Hidden files are skipped, and never deleted.
+    Returns the counts of copied, unchanged, and deleted files.
+    """
+    from multiprocessing.pool import ThreadPool
+    src_files = _list_tree(src)
+    if os.path.isdir(dest):
+        dest_files = _list_tree(dest)
+    else:
+        dest_files = set()
+
+    def sync_file(rel):
+        src_path = os.path.join(src,rel)
+        dest_path = os.path.join(dest,rel)
+        src_stat = os.stat(src_path)
+        if rel in dest_files:
+            dest_stat = os.stat(dest_path)
+            if src_stat.st_size == dest_stat.st_size:
+                if int(src_stat.st_mtime) == int(dest_stat.st_mtime):
+                    return False
+                if _file_digest(src_path) == _file_digest(dest_path):
+                    os.utime(dest_path,(dest_stat.st_atime,src_stat.st_mtime))
+                    return False
+            os.remove(dest_path)
+        try:
+            os.makedirs(os.path.dirname(dest_path))
+        except Exception:
+            pass
+        shutil.copy2(src_path,dest_path)
+        return True
+
     try:
         os.makedirs(dest)
     except Exception:
         pass
-    for p in os.listdir(src):
-        if p.startswith('.'):
-            continue
-        path = os.path.join(src,p)
-        if os.path.isdir(path):
-            copy_src(path,os.path.join(dest,p))
-        else:
-            shutil.copy2(path,dest)
+    pool = ThreadPool(workers)
+    try:
+        copied = sum(pool.map(sync_file,sorted(src_files)))
+    finally:
+        pool.close()
+        pool.join()
+
+    deleted = 0
+    if delete:
+        for rel in sorted(dest_files - src_files):
+            os.remove(os.path.join(dest,rel))
+            deleted += 1
+        for root,dirs,files in os.walk(dest,topdown=False):
+            rel = os.path.relpath(root,dest)
+            if rel != '.' and not any(p.startswith('.') or p == '__pycache__' for p in rel.split(os.sep)):
+                if not os.listdir(root):
+                    os.rmdir(root)
+
+    ret = {'copied':copied,'unchanged':len(src_files)-copied,'deleted':deleted}
+    print('sync %s %s copied %d, unchanged %d, deleted %d'%(src,dest,ret['copied'],ret['unchanged'],ret['deleted']))
+    return ret
+
+def copy_src(src,dest):
+    """Copy anything from src to dest, skipping unchanged files"""
+    return sync_tree(src,dest)
 
 def load_env(dir_name, reset=None):
     """Load the environment from dir/setup.sh"""
@@ -32,7 +32,7 @@ def install_pip(dir_name,version=None):
         try:
             tmp_dir = tempfile.mkdtemp()
             path = os.path.join(tmp_dir,name)
-            wget('https://bootstrap.pypa.io/get-pip.py',path)
+            wget('https://bootstrap.pypa.io/get-pip.py',path,cache=False)
             if subprocess.call([os.path.join(dir_name,'bin','python'),path,'-I','--quiet']):
                 raise Exception('pip failed to install')
             if not os.path.exists(os.path.join(dir_name,'bin','pip')):
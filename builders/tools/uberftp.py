@@ -15,7 +15,7 @@ def install(dir_name,version=None):
         try:
             tmp_dir = tempfile.mkdtemp()
             path = os.path.join(tmp_dir,name)
-            wget(url,path)
+            wget(url,path,cache=False)
             unpack(path,tmp_dir)
             src_dir = os.path.join(tmp_dir,'UberFTP-master')
             globus_include = os.path.join(dir_name,'include','gcc64dbg')
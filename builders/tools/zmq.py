@@ -34,7 +34,7 @@ def install(dir_name,version=None):
             # the c++ bindings
             url = 'https://raw.githubusercontent.com/zeromq/cppzmq/master/zmq.hpp'
             path = os.path.join(dir_name,'include','zmq.hpp')
-            wget(url,path)
+            wget(url,path,cache=False)
         finally:
             shutil.rmtree(tmp_dir)
 
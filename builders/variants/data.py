@@ -26,12 +26,11 @@ def nugen_tables(dir_name):
         os.mkdir(nugen_dir)
     tmp_dir = tempfile.mkdtemp()
     try:
-        tmp_path = os.path.join(tmp_dir,'nugen-v3-tables.tgz')
         md5sum_path = os.path.join(tmp_dir,'nugen-v3-tables.md5sum')
-        wget('http://code.icecube.wisc.edu/tools/neutrino-generator/nugen-v3-tables.tgz',tmp_path)
-        wget('http://code.icecube.wisc.edu/tools/neutrino-generator/nugen-v3-tables.md5sum',md5sum_path)
-        check_md5sum(tmp_path,md5sum=md5sum_path)
-        unpack(tmp_path,nugen_dir)
+        wget('http://code.icecube.wisc.edu/tools/neutrino-generator/nugen-v3-tables.md5sum',md5sum_path,cache=False)
+        # download, check, and unpack in one pass
+        fetch_unpack('http://code.icecube.wisc.edu/tools/neutrino-generator/nugen-v3-tables.tgz',
+                     nugen_dir,md5sum=md5sum_path)
     finally:
         shutil.rmtree(tmp_dir)
 
@@ -41,12 +40,11 @@ def clsim_tables(dir_name):
     tmp_dir = tempfile.mkdtemp()
     try:
         md5sums = os.path.join(tmp_dir,'MD5SUMS')
-        wget(os.path.join(base,'MD5SUMS'), md5sums)
+        wget(os.path.join(base,'MD5SUMS'), md5sums, cache=False)
         for f in ('safeprimes_base32.gz','safeprimes_base32.txt'):
             path = os.path.join(dir_name,f)
             if not os.path.exists(path):
-                wget(os.path.join(base,f), path)
-                check_md5sum(path,md5sum=md5sums)
+                wget(os.path.join(base,f), path, md5sum=md5sums)
     finally:
         shutil.rmtree(tmp_dir)
 
@@ -6,6 +6,8 @@ from __future__ import print_function
 
 import sys
 import os
+import re
+import json
 import shutil
 import tempfile
 import time
@@ -199,7 +201,250 @@ def get_packages(filename):
             ret[name] = line
     return ret
 
-def get_dependencies(spack_path, package, packages):
+def version_key(version):
+    """Sort key for a version string, comparing numeric parts as numbers"""
+    return [(0, int(p), '') if p.isdigit() else (1, 0, p) for p in re.findall(r'\d+|[a-zA-Z]+', version)]
+
+class InstalledIndex(object):
+    """
+    Index of the packages installed with our compiler.
+
+    Reads the spack database JSON directly instead of parsing
+    `spack find` output, so lookups need no subprocess.  Call
+    `reload()` after installing or uninstalling; the database is
+    only parsed again if it changed.
+
+    Args:
+        spack_path (str): path to spack
+    """
+    def __init__(self, spack_path):
+        self.db_path = os.path.join(spack_path,'opt','spack','.spack-db','index.json')
+        self.db_stat = None
+        self.packages = {}
+        self.reload()
+
+    @staticmethod
+    def _node(spec):
+        """Get the name and node of a database spec, in old or new format"""
+        if 'name' in spec and 'version' in spec:
+            return spec['name'], spec
+        name = list(spec)[0]
+        return name, spec[name]
+
+    def reload(self):
+        """Load the database, if it changed"""
+        try:
+            st = os.stat(self.db_path)
+        except OSError:
+            self.db_stat = None
+            self.packages = {}
+            return
+        if self.db_stat == (st.st_mtime, st.st_size):
+            return
+        with open(self.db_path) as f:
+            installs = json.load(f).get('database',{}).get('installs',{})
+        packages = {}
+        for hash, record in installs.items():
+            if not record.get('installed', True):
+                continue
+            name, node = self._node(record['spec'])
+            # test for our compiler
+            compiler = node.get('compiler',{})
+            if 'spack' not in '{}@{}'.format(compiler.get('name',''), compiler.get('version','')):
+                continue
+            packages.setdefault(name,{})[str(node.get('version',''))] = name+'/'+hash[:7]
+        self.db_stat = (st.st_mtime, st.st_size)
+        self.packages = packages
+
+    def is_installed(self, name, version=None):
+        """Check if a package is installed, optionally at a version"""
+        if version is None:
+            return name in self.packages
+        return version in self.packages.get(name,{})
+
+    def get_installed_packages(self):
+        """
+        Get the packages installed with our compiler.
+
+        If a package has several versions installed, the highest is used.
+
+        Returns:
+            dict: {name: name/hash}
+        """
+        return {name: versions[max(versions, key=version_key)] for name,versions in self.packages.items()}
+
+def get_dependency_pins(dependencies, packages, installed_packages):
+    """
+    Get the `^dep` spec arguments that pin dependencies.
+
+    Installed dependencies are pinned by hash, others to the
+    version in our package list.
+
+    Args:
+        dependencies (iterable): dependency names
+        packages (dict): all packages in our list
+        installed_packages (dict): {name: name/hash}
+    Returns:
+        list: spec arguments
+    """
+    ret = []
+    for d in sorted(dependencies):
+        if d in installed_packages:
+            parts = installed_packages[d].split()
+        elif d in packages:
+            parts = packages[d].split()
+        else:
+            raise Exception('bad dep: '+d)
+        parts[0] = '^'+parts[0]
+        ret.extend(parts)
+    return ret
+
+def parse_spec_trees(output):
+    """
+    Parse the concretized specs from `spack spec` output.
+
+    Returns:
+        list: [set of dependency names], for each input spec in order
+    """
+    trees = []
+    deps = None
+    for line in output.split('\n'):
+        line = line.strip()
+        if line == 'Input spec':
+            deps = None
+        elif line == 'Concretized':
+            deps = set()
+            trees.append(deps)
+        elif deps is not None and line.startswith('^'):
+            deps.add(line.split('@', 1)[0].lstrip('^'))
+    return trees
+
+class DependencyResolver(object):
+    """
+    Resolve dependency pins for many packages with batched concretization.
+
+    All pending packages are concretized together in one `spack spec`
+    call, repeating with the new pins until they stop changing.  A
+    package the batch cannot concretize is dropped from it, and falls
+    back to `resolve_dependencies`.
+
+    The dependency names are cached on disk by package string, along
+    with the inputs that decided them: for each package in the
+    concretized tree, its entry in our package list, or whether it is
+    installed.  A cached entry is reused until one of those changes.
+    Pins are made at install time, so dependencies installed earlier
+    in the run are pinned by hash.
+
+    Args:
+        spack_path (str): path to spack
+        packages (dict): all packages in our list
+        index (InstalledIndex): installed package index
+    """
+    def __init__(self, spack_path, packages, index):
+        self.spack_path = spack_path
+        self.spack_bin = os.path.join(spack_path,'bin','spack')
+        self.packages = packages
+        self.index = index
+        self.cache_path = os.path.join(spack_path,'var','spack','icecube-dependency-cache.json')
+        self.cache = {}
+        self.resolved = set()
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    self.cache = json.load(f)
+            except Exception:
+                myprint('cannot read dependency cache', self.cache_path)
+
+    def _inputs(self, tree, installed_packages):
+        """Get the inputs that decide which dependencies in a tree are pinned"""
+        ret = {}
+        for d in tree:
+            if d in self.packages:
+                ret[d] = self.packages[d]
+            elif d in installed_packages:
+                ret[d] = 'installed'
+            else:
+                ret[d] = ''
+        return ret
+
+    def _save(self):
+        tmp_path = self.cache_path+'.tmp'
+        with open(tmp_path,'w') as f:
+            json.dump(self.cache, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.cache_path)
+
+    def resolve(self, pending, max_rounds=10):
+        """
+        Resolve the dependencies of many packages at once.
+
+        Args:
+            pending (list): package install strings
+            max_rounds (int): max number of concretizations
+        """
+        installed_packages = self.index.get_installed_packages()
+        todo = []
+        for package in pending:
+            entry = self.cache.get(package)
+            if entry and self._inputs(entry['tree'], installed_packages) == entry['tree']:
+                self.resolved.add(package)
+            else:
+                todo.append(package)
+        myprint('resolving dependencies:', len(pending)-len(todo), 'cached,', len(todo), 'to resolve')
+        dependencies = dict((p, set()) for p in todo)
+        rounds = 0
+        while todo:
+            if rounds >= max_rounds:
+                myprint('batch concretization did not converge, resolving one package at a time')
+                return
+            cmd = [self.spack_bin, 'spec']
+            for package in todo:
+                cmd += package.split()+get_dependency_pins(dependencies[package], self.packages, installed_packages)
+            code,output,error = run_cmd_output(cmd)
+            trees = parse_spec_trees(output)
+            if code != 0:
+                if len(trees) >= len(todo):
+                    myprint('batch concretization failed, resolving one package at a time')
+                    return
+                # spack stops at the first spec it cannot concretize
+                failed = todo.pop(len(trees))
+                myprint('batch concretization failed for', failed.split()[0], '- resolving it separately')
+                continue
+            rounds += 1
+            trees = dict(zip(todo, trees))
+            new_deps = dict((p, set(d for d in trees[p] if d in self.packages or d in installed_packages)) for p in todo)
+            if new_deps == dict((p, dependencies[p]) for p in todo):
+                break
+            dependencies.update(new_deps)
+        for package in todo:
+            self.cache[package] = {
+                'pins': sorted(dependencies[package]),
+                'tree': self._inputs(trees[package], installed_packages),
+            }
+            self.resolved.add(package)
+        if todo:
+            self._save()
+
+    def get_dependencies(self, package):
+        """
+        Get the dependency pins for a package.
+
+        Args:
+            package (str): the package install string
+        Returns:
+            list: [dependencies]
+        """
+        if package not in self.resolved:
+            tree = set()
+            names = resolve_dependencies(self.spack_path, package, self.packages, self.index, tree=tree)
+            self.cache[package] = {
+                'pins': names,
+                'tree': self._inputs(tree, self.index.get_installed_packages()),
+            }
+            self.resolved.add(package)
+            self._save()
+        return get_dependency_pins(self.cache[package]['pins'], self.packages, self.index.get_installed_packages())
+
+def get_dependencies(spack_path, package, packages, index=None):
     """
     Get the correct versions for all dependencies.
 
@@ -210,24 +455,32 @@ def get_dependencies(spack_path, package, packages):
         spack_path (str): path to spack
         package (str): the package to check
         packages (dict): all installed packages
+        index (InstalledIndex): installed package index (optional)
     Returns:
         list: [dependencies]
     """
+    if not index:
+        index = InstalledIndex(spack_path)
+    dependencies = resolve_dependencies(spack_path, package, packages, index)
+    return get_dependency_pins(dependencies, packages, index.get_installed_packages())
+
+def resolve_dependencies(spack_path, package, packages, index=None, tree=None):
+    """
+    Get the names of the dependencies to pin, one concretization at a time.
+
+    Args:
+        spack_path (str): path to spack
+        package (str): the package to check
+        packages (dict): all installed packages
+        index (InstalledIndex): installed package index (optional)
+        tree (set): filled with all dependency names of the package (optional)
+    Returns:
+        list: [dependency names]
+    """
     spack_bin = os.path.join(spack_path,'bin','spack')
-    cmd = [spack_bin, 'find', '--show-full-compiler', '-lv']
-    code,output,error = run_cmd_output(cmd)
-    installed_packages = {}
-    for line in output.split('\n'):
-        line = line.strip()
-        if (not line) or line.startswith('--') or line.startswith('==>'):
-            continue
-        parts = line.split()
-        # test for our compiler
-        if 'spack' not in parts[1].split('%',1)[-1]:
-            continue
-        name = parts[1].split('@',1)[0]
-        hash = parts[0]
-        installed_packages[name] = name+'/'+hash
+    if not index:
+        index = InstalledIndex(spack_path)
+    installed_packages = index.get_installed_packages()
 
     dependencies = set()
     ret = []
@@ -260,10 +513,12 @@ def get_dependencies(spack_path, package, packages):
                 success = True
             if success:
                 new_deps = set()
+                all_deps = set()
                 for line in output.split('\n'):
                     line = line.strip()
                     if line.startswith('^'):
                         dep = line.split('@', 1)[0].lstrip('^')
+                        all_deps.add(dep)
                         print('dep:',dep)
                         if dep in packages:
                             print('   found', packages[dep])
@@ -272,6 +527,8 @@ def get_dependencies(spack_path, package, packages):
                             print('   installed', installed_packages[dep])
                             new_deps.add(dep)
                 if new_deps == dependencies:
+                    if tree is not None:
+                        tree.update(all_deps)
                     break
                 dependencies = new_deps
             else:
@@ -290,42 +547,20 @@ def get_dependencies(spack_path, package, packages):
                     print(error)
                     raise Exception('bad dependencies')
 
-        ret = []
-        for d in dependencies:
-            if d in installed_packages:
-                parts = installed_packages[d].split()
-            elif d in packages:
-                parts = packages[d].split()
-            else:
-                raise Exception('bad dep: '+d)
-            parts[0] = '^'+parts[0]
-            ret.extend(parts)
+        ret = get_dependency_pins(dependencies, packages, installed_packages)
     else:
         print(output)
         print(error)
         raise Exception('bad dependencies')
 
-    return ret
+    return sorted(dependencies)
 
-def is_installed(spack_path, package):
+def is_installed(spack_path, package, index=None):
     """Check if a package is installed"""
     name = package.split('@')[0]
-    spack_bin = os.path.join(spack_path,'bin','spack')
-    cmd = [spack_bin, 'find', '--show-full-compiler', '-v']
-    code,output,error = run_cmd_output(cmd)
-    installed_packages = {}
-    for line in output.split('\n'):
-        line = line.strip()
-        if (not line) or line.startswith('--') or line.startswith('==>'):
-            continue
-        parts = line.split()
-        # test for our compiler
-        if 'spack' not in parts[0].split('%',1)[-1]:
-            continue
-        pkg_name = parts[0].split('@',1)[0]
-        if name == pkg_name:
-            return True
-    return False
+    if not index:
+        index = InstalledIndex(spack_path)
+    return index.is_installed(name)
 
 def uninstall(spack_path, sroot, package):
     """Uninstall package and remove from view"""
@@ -497,18 +732,25 @@ def build(src, dest, version, mirror=None):
         cmd = [spack_bin, 'install', '-y', '-v', '--no-checksum']
         if 'CPUS' in os.environ:
             cmd.extend(['-j', os.environ['CPUS']])
+        index = InstalledIndex(spack_path)
+        # resolve dependencies for everything that may be installed, at once
+        resolver = DependencyResolver(spack_path, packages, index)
+        resolver.resolve([package for package in packages.values()
+                          if '@develop' in package.split()[0] or not is_installed(spack_path, package.split()[0], index)])
         for name, package in packages.items():
             myprint('installing', name)
             main_pkg = package.split()[0]
-            installed = is_installed(spack_path, main_pkg)
+            installed = is_installed(spack_path, main_pkg, index)
             if '@develop' in main_pkg and installed:
                 uninstall(spack_path, sroot, main_pkg)
+                index.reload()
             elif installed:
                 myprint(name, 'already installed')
                 continue
-            deps = get_dependencies(spack_path, package, packages)
+            deps = resolver.get_dependencies(package)
             fileMirror.download(package)
             run_cmd(cmd+package.split()+deps)
+            index.reload()
 
         # set up dirs
         for d in ('bin',):
@@ -6,12 +6,22 @@ Or IceProd versions >=v2.7.
 import sys
 import os
 import json
+import hashlib
+import re
 from pathlib import Path
 import shutil
 import tempfile
+import textwrap
 import time
 import subprocess
+import threading
+import urllib.error
+import urllib.request
+import resource
+import shlex
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 
 def myprint(*args,**kwargs):
@@ -20,10 +30,33 @@ def myprint(*args,**kwargs):
     sys.stdout.flush()
 
 
+# peak RSS (in bytes) of child processes run with check_call
+_child_peak_rss = 0
+
+
+def check_call(*args, **kwargs):
+    """
+    Like `subprocess.check_call`, but reap the child with `os.wait4`
+    to record its peak memory usage.
+    """
+    global _child_peak_rss
+    p = subprocess.Popen(*args, **kwargs)
+    try:
+        pid, status, rusage = os.wait4(p.pid, 0)
+    except BaseException:
+        p.kill()
+        p.wait()
+        raise
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    _child_peak_rss = max(_child_peak_rss, rusage.ru_maxrss*1024)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, args[0] if args else kwargs.get('args'))
+
+
 def run_cmd(*args, **kwargs):
     """print and run a subprocess command"""
     myprint('cmd:',*args)
-    subprocess.check_call(*args, **kwargs)
+    check_call(*args, **kwargs)
 
 
 def run_cmd_output(*args, **kwargs):
@@ -42,7 +75,14 @@ def run_cmd_sroot(args, srootbase, **kwargs):
     myprint('cmd:',args)
     cmd = 'eval $('+os.path.join(srootbase,'setup.sh')+') ; '
     cmd += ' '.join(args)
-    subprocess.check_call(cmd, shell=True, **kwargs)
+    check_call(cmd, shell=True, **kwargs)
+
+
+def run_cmd_sroot_output(args, srootbase, **kwargs):
+    """print and run a subprocess command, inside an sroot environment, with output"""
+    cmd = 'eval $('+os.path.join(srootbase,'setup.sh')+') ; '
+    cmd += ' '.join(args)
+    return run_cmd_output(cmd, shell=True, **kwargs)
 
 
 def run_cmd_source_env(source_script, lines):
@@ -56,7 +96,7 @@ def run_cmd_source_env(source_script, lines):
             for line in lines:
                 print(line, file=f)
         myprint('script:\n', open(script).read())
-        subprocess.check_call(f'bash {script}', shell=True)
+        check_call(f'bash {script}', shell=True)
 
 
 def get_sroot(dir_name):
@@ -73,21 +113,134 @@ def get_sroot_no_arch(dir_name, *args):
     return s.parent / '_'.join(s.name.split('_')[:2])
 
 
-def copy_src(src, dest):
-    """Copy anything from src to dest"""
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _list_tree(path):
+    """List files under path, relative to it, skipping hidden files and `__pycache__`"""
+    ret = set()
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+        rel = os.path.relpath(root, path)
+        for name in files:
+            if not name.startswith('.'):
+                ret.add(os.path.normpath(os.path.join(rel, name)))
+    return ret
+
+
+def sync_tree(src, dest, delete=False, workers=8):
+    """
+    Sync files from src to dest, copying only what changed.
+
+    A file is unchanged if the size and mtime match, or failing that,
+    if the contents match (and then the mtime is updated).  Hidden files
+    and `__pycache__` are skipped, and never deleted.
+
+    Args:
+        src (str): source directory
+        dest (str): destination directory
+        delete (bool): delete files in dest that are not in src
+        workers (int): number of copy threads
+    Returns:
+        dict: counts of copied, unchanged, and deleted files
+    """
     src = str(src)
     dest = str(dest)
-    print("copy_src", src, dest)
-    if not os.path.exists(dest):
-        os.makedirs(dest)
-    for p in os.listdir(src):
-        if p.startswith('.'):
-            continue
-        path = os.path.join(src, p)
-        if os.path.isdir(path):
-            copy_src(path, os.path.join(dest, p))
-        else:
-            shutil.copy2(path, dest)
+    src_files = _list_tree(src)
+    dest_files = _list_tree(dest) if os.path.isdir(dest) else set()
+
+    def sync_file(rel):
+        src_path = os.path.join(src, rel)
+        dest_path = os.path.join(dest, rel)
+        src_stat = os.stat(src_path)
+        if rel in dest_files:
+            dest_stat = os.stat(dest_path)
+            if src_stat.st_size == dest_stat.st_size:
+                if int(src_stat.st_mtime) == int(dest_stat.st_mtime):
+                    return False
+                if _file_digest(src_path) == _file_digest(dest_path):
+                    os.utime(dest_path, (dest_stat.st_atime, src_stat.st_mtime))
+                    return False
+            os.remove(dest_path)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        shutil.copy2(src_path, dest_path)
+        return True
+
+    os.makedirs(dest, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        copied = sum(pool.map(sync_file, sorted(src_files)))
+
+    deleted = 0
+    if delete:
+        for rel in sorted(dest_files - src_files):
+            os.remove(os.path.join(dest, rel))
+            deleted += 1
+        for root, dirs, files in os.walk(dest, topdown=False):
+            rel = os.path.relpath(root, dest)
+            if rel != '.' and not any(p.startswith('.') or p == '__pycache__' for p in rel.split(os.sep)):
+                if not os.listdir(root):
+                    os.rmdir(root)
+
+    ret = {'copied': copied, 'unchanged': len(src_files)-copied, 'deleted': deleted}
+    print('sync', src, dest, f'copied {ret["copied"]}, unchanged {ret["unchanged"]}, deleted {ret["deleted"]}')
+    return ret
+
+
+def copy_src(src, dest):
+    """Copy anything from src to dest, skipping unchanged files"""
+    return sync_tree(src, dest)
+
+
+def get_repo_path(version):
+    """
+    Get the custom spack repo for a version.
+
+    Args:
+        version (list): version path components
+    Returns:
+        str: path to the repo
+    """
+    base = os.path.dirname(__file__)
+    repo_path = os.path.join(base, *version)+'-repo'
+    if (not os.path.exists(repo_path)) and len(version) == 2 and '.' in version[1]:
+        repo_path = os.path.join(base, version[0], '.'.join(version[1].split('.')[:2]))+'-repo'
+    if (not os.path.exists(repo_path)) and len(version) > 1:
+        repo_path = os.path.join(base, version[0])+'-repo'
+    if (not os.path.exists(repo_path)) and '.' in version[0]:
+        repo_path = os.path.join(base, '.'.join(version[0].split('.')[:2]), *version[1:])+'-repo'
+    if (not os.path.exists(repo_path)) and '.' in version[0]:
+        repo_path = os.path.join(base, version[0].split('.')[0], *version[1:])+'-repo'
+    if not os.path.exists(repo_path): # last resort
+        repo_path = os.path.join(base, 'repo')
+    return repo_path
+
+
+def hash_tree(path, digest):
+    """
+    Add the relative paths and contents of all files in a directory to a digest.
+
+    Hidden files are skipped, like in `copy_src`, along with `__pycache__`.
+
+    Args:
+        path (str): directory to hash
+        digest: a hashlib object to update
+    """
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != '__pycache__')
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            filename = os.path.join(root, name)
+            digest.update(os.path.relpath(filename, path).encode('utf-8')+b'\0')
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1<<20), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
 
 
 def get_packages(filename):
@@ -110,29 +263,167 @@ def get_packages(filename):
     return ret
 
 
-def get_installed_packages(spack_bin, compiler='spack'):
-    cmd = [spack_bin, 'find', '--show-full-compiler', '-lv']
-    code,output,error = run_cmd_output(cmd)
-    installed_packages = {}
-    for line in output.split('\n'):
-        line = line.strip()
-        if (not line) or line.startswith('--') or line.startswith('==>'):
-            continue
-        parts = line.split()
-        # test for our compiler
-        if compiler not in parts[1].split('%',1)[-1]:
-            continue
-        name = parts[1].split('@',1)[0]
-        hash = parts[0]
-        installed_packages[name] = name+'/'+hash
-    myprint('installed packages:', list(installed_packages))
-    return installed_packages
+class SpackQuery:
+    """
+    In-memory snapshot of spack state.
+
+    Every spack command costs seconds of start-up, so the install database,
+    compilers, repos, mirrors, and arch are each queried once and then served
+    from memory.  Call `invalidate` after a step that mutates spack state.
+
+    Args:
+        spack_bin (str): path to the spack executable
+    """
+    CATEGORIES = ('installed', 'prefixes', 'compilers', 'repos', 'mirrors', 'arch')
+
+    def __init__(self, spack_bin):
+        self.spack_bin = spack_bin
+        self._cache = {}
+
+    def snapshot(self):
+        """Load all missing categories at once, running the spack queries concurrently"""
+        missing = [c for c in self.CATEGORIES if c not in self._cache]
+        if not missing:
+            return
+        with ThreadPoolExecutor(len(missing)) as pool:
+            results = list(pool.map(lambda c: getattr(self, '_load_'+c)(), missing))
+        self._cache.update(zip(missing, results))
+
+    def invalidate(self, *categories):
+        """Drop cached categories (default: all), so the next lookup queries spack again"""
+        categories = set(categories if categories else self.CATEGORIES)
+        if 'installed' in categories:
+            categories.add('prefixes')
+        for c in categories:
+            self._cache.pop(c, None)
+
+    def _get(self, category):
+        if category not in self._cache:
+            self._cache[category] = getattr(self, '_load_'+category)()
+        return self._cache[category]
+
+    def _load_installed(self):
+        code,output,error = run_cmd_output([self.spack_bin, 'find', '--json'])
+        if code != 0 or not output.strip():
+            return []
+        return json.loads(output)
+
+    def _load_prefixes(self):
+        cmd = [self.spack_bin, 'find', '--format', '{name}@{version}/{hash} {prefix}']
+        code,output,error = run_cmd_output(cmd)
+        prefixes = {'by_prefix': {}, 'by_hash': {}}
+        for line in output.split('\n'):
+            parts = line.split()
+            if len(parts) != 2 or line.startswith('==>'):
+                continue
+            spec, spec_hash = parts[0].rsplit('/', 1)
+            prefixes['by_prefix'][parts[1]] = f'{spec}/{spec_hash[:7]}'
+            prefixes['by_hash'][spec_hash] = parts[1]
+        return prefixes
+
+    def _load_compilers(self):
+        code,output,error = run_cmd_output([self.spack_bin, 'compiler', 'list'])
+        compilers = []
+        platform_os = ''
+        for line in output.split('\n'):
+            if line.startswith('--'):
+                platform_os = line.replace('-', ' ').strip().split()[1]
+            elif line.strip() and not line.startswith('==>'):
+                for comp in line.split():
+                    compilers.append((platform_os, comp))
+        return compilers
+
+    def _load_repos(self):
+        code,output,error = run_cmd_output([self.spack_bin, 'repo', 'list', '--scope', 'site'])
+        repos = []
+        for line in output.split('\n'):
+            parts = line.split()
+            if len(parts) < 2 or line.startswith('==>'):
+                continue
+            repos.append((parts[-2], parts[-1]))
+        return repos
+
+    def _load_mirrors(self):
+        code,output,error = run_cmd_output([self.spack_bin, 'mirror', 'list'])
+        return [line.strip() for line in output.split('\n') if line.strip()]
+
+    def _load_arch(self):
+        code,output,error = run_cmd_output([self.spack_bin, 'arch'])
+        if code != 0:
+            raise Exception('Failed to get spack arch')
+        return output.strip()
+
+    def installed(self):
+        """Get the install database, as from `spack find --json`"""
+        return self._get('installed')
+
+    def find(self, name, arch=None):
+        """Get installed specs matching a package name, and optionally an arch"""
+        return [pkg for pkg in self.installed()
+                if pkg['name'] == name and (arch is None or pkg['arch'] == arch)]
+
+    def prefixes(self):
+        """Get install prefixes, as {prefix: name@version/short hash}"""
+        return self._get('prefixes')['by_prefix']
+
+    def hash_prefixes(self):
+        """Get install prefixes, as {hash: prefix}"""
+        return self._get('prefixes')['by_hash']
+
+    def has_compiler(self, compiler, platform_os):
+        """Check if a compiler spec is registered with spack for an OS"""
+        return (platform_os, compiler) in self._get('compilers')
+
+    def has_compilers(self, platform_os):
+        """Check if any compilers are registered with spack for an OS"""
+        return any(os_name == platform_os for os_name, _ in self._get('compilers'))
+
+    def repos(self):
+        """Get site repos, as [(namespace, path)]"""
+        return self._get('repos')
+
+    def has_mirror(self, url):
+        """Check if a mirror url is configured"""
+        return any(url in line for line in self._get('mirrors'))
+
+    def arch(self):
+        """Get the spack arch, as [platform, platform_os, target]"""
+        return self._get('arch').split('-')
+
+
+def read_spack_lock(path):
+    """
+    Read the concrete specs from a spack.lock file.
+
+    Args:
+        path (str): path to spack.lock
+    Returns:
+        dict: {hash: spec node dict}
+    """
+    with open(path) as f:
+        lock = json.load(f)
+    return lock.get('concrete_specs', {})
 
 
 class Mirror:
+    """
+    A spack source mirror.
+
+    For filesystem mirrors, the directory listing is read once into an
+    index, so checking for missing sources does not touch the disk
+    for every package.  Patches are checked against the content-addressed
+    `_source-cache/archive` store.  Patch hashes that spack does not store
+    there (patches in the package repo, or inside a patch archive) are
+    remembered in `.unmirrored-patches.json` after the first fetch.
+    """
+    EXTENSIONS = ('.tar.gz', '.tar.bz2', '.tar.xz', '.tgz', '.tbz2', '.txz', '.tar', '.zip')
+
     def __init__(self, mirror_path, spack_bin=None):
         self.mirror_path = mirror_path
         self.spack_bin = spack_bin
+        self._index = None
+        self._archives = None
+        self._unmirrored = None
         if mirror_path and mirror_path.startswith('/') and not spack_bin:
             # set up spack latest version for mirror
             spack_path = os.path.join(os.getcwd(), 'spack')
@@ -141,20 +432,68 @@ class Mirror:
                 run_cmd(['git', 'clone', url, spack_path])
             self.spack_bin = os.path.join(spack_path, 'bin', 'spack')
 
+    def index(self):
+        """Get the mirror index, as {package name: set of archive names}"""
+        if self._index is None:
+            self._index = {}
+            if self.mirror_path and os.path.isdir(self.mirror_path):
+                for name in os.listdir(self.mirror_path):
+                    path = os.path.join(self.mirror_path, name)
+                    if name.startswith(('.', '_')) or not os.path.isdir(path):
+                        continue
+                    self._index[name] = set(os.listdir(path))
+        return self._index
+
+    def archives(self):
+        """Get the sha256 hashes in the content-addressed archive store"""
+        if self._archives is None:
+            self._archives = set()
+            path = os.path.join(self.mirror_path, '_source-cache', 'archive') if self.mirror_path else None
+            if path and os.path.isdir(path):
+                for prefix in os.listdir(path):
+                    if os.path.isdir(os.path.join(path, prefix)):
+                        self._archives.update(f.split('.', 1)[0] for f in os.listdir(os.path.join(path, prefix)))
+        return self._archives
+
+    def _unmirrored_path(self):
+        return os.path.join(self.mirror_path, '.unmirrored-patches.json')
+
+    def unmirrored(self):
+        """Get the patch hashes that spack does not store in the mirror"""
+        if self._unmirrored is None:
+            self._unmirrored = set()
+            if self.mirror_path and os.path.isfile(self._unmirrored_path()):
+                try:
+                    with open(self._unmirrored_path()) as f:
+                        self._unmirrored = set(json.load(f))
+                except Exception:
+                    myprint('cannot read', self._unmirrored_path())
+        return self._unmirrored
+
+    def _refresh(self, name):
+        path = os.path.join(self.mirror_path, name)
+        if os.path.isdir(path):
+            self.index()[name] = set(os.listdir(path))
+
+    def has(self, name, version):
+        """Check if the source for a package version is in the mirror"""
+        files = self.index().get(name, set())
+        return any(f'{name}-{version}{ext}' in files for ext in self.EXTENSIONS)
+
+    def missing_patches(self, spec):
+        """Get the patch hashes of a concrete spec that are not in the mirror"""
+        patches = spec.get('parameters', {}).get('patches', [])
+        return [p for p in patches if p not in self.archives() and p not in self.unmirrored()]
+
+    def has_spec(self, spec):
+        """Check if the source and patches for a concrete spec are in the mirror"""
+        return self.has(spec['name'], spec['version']) and not self.missing_patches(spec)
+
     def download(self, package):
         if self.mirror_path and self.spack_bin:
             pkg_version = package.split()[0]
             pkg_name = pkg_version.split('@')[0]
-            pkg_version_name = pkg_version.replace('@','-')+'.tar.gz'
-            if os.path.exists(os.path.join(self.mirror_path, pkg_name, pkg_version_name)):
-                myprint(pkg_version+' already in mirror')
-                return
-            pkg_version_name = pkg_version.replace('@','-')+'.tar.bz2'
-            if os.path.exists(os.path.join(self.mirror_path, pkg_name, pkg_version_name)):
-                myprint(pkg_version+' already in mirror')
-                return
-            pkg_version_name = pkg_version.replace('@','-')+'.tar.xz'
-            if os.path.exists(os.path.join(self.mirror_path, pkg_name, pkg_version_name)):
+            if self.has(pkg_name, pkg_version.split('@',1)[-1]):
                 myprint(pkg_version+' already in mirror')
                 return
             myprint('attempting to add '+pkg_version+' to mirror')
@@ -163,6 +502,330 @@ class Mirror:
             except Exception as e:
                 myprint('failed to add '+pkg_version+' to mirror', e)
                 pass
+            self._refresh(pkg_name)
+
+    def prefetch(self, specs, spack_args=(), workers=8):
+        """
+        Add all missing sources for a set of concrete specs to the mirror.
+
+        A spec is missing if its source archive or any of its patches
+        is not in the mirror.  Fetching a concrete spec also fetches its
+        patches and resources.  Resources are not listed in the concrete
+        spec, so a spec whose source and patches are present is not
+        checked for them.  Specs are fetched concurrently, with one spack
+        process per spec.
+
+        Args:
+            specs (dict): {hash: spec node dict}, as from `read_spack_lock`
+            spack_args (list): extra spack args, like `-e <env>` to resolve hashes
+            workers (int): max number of concurrent fetches
+        """
+        if not (self.mirror_path and self.mirror_path.startswith('/') and self.spack_bin):
+            return
+        specs = {h: spec for h, spec in specs.items() if 'external' not in spec}
+        missing = [(h, spec['name'], spec['version']) for h, spec in specs.items()
+                   if not self.has_spec(spec)]
+        myprint(f'mirror: {len(specs)-len(missing)} of {len(specs)} sources present, fetching {len(missing)}')
+        if not missing:
+            return
+
+        def fetch(item):
+            h, name, version = item
+            cmd = [self.spack_bin]+list(spack_args)+['mirror', 'create', '-d', self.mirror_path, '/'+h]
+            return run_cmd_output(cmd)
+
+        failed = []
+        with ThreadPoolExecutor(max(1, min(workers, len(missing)))) as pool:
+            for (h, name, version), (code, output, error) in zip(missing, pool.map(fetch, missing)):
+                if code != 0:
+                    myprint(f'failed to add {name}@{version} to mirror:', error.strip())
+                    failed.append(name)
+                self._refresh(name)
+
+        # patches still missing after a successful fetch are not stored by spack
+        self._archives = None
+        unmirrored = set()
+        for h, name, version in missing:
+            if name not in failed:
+                unmirrored.update(self.missing_patches(specs[h]))
+        if unmirrored:
+            self.unmirrored().update(unmirrored)
+            tmp_path = self._unmirrored_path()+'.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(sorted(self.unmirrored()), f, indent=1)
+            os.replace(tmp_path, self._unmirrored_path())
+        myprint(f'mirror: fetched {len(missing)-len(failed)} sources, {len(failed)} failed')
+
+
+def get_dependency_dag(specs):
+    """
+    Get the dependency DAG of concrete specs.
+
+    Test-only dependencies are ignored.
+
+    Args:
+        specs (dict): {hash: spec node dict}, as from `read_spack_lock`
+    Returns:
+        dict: {hash: set of dependency hashes}
+    """
+    dag = {}
+    for h, spec in specs.items():
+        deps = spec.get('dependencies', [])
+        if isinstance(deps, dict):
+            deps = [dict(d, name=name) for name, d in deps.items()]
+        dag[h] = set()
+        for dep in deps:
+            params = dep.get('parameters', dep)
+            deptypes = params.get('deptypes', params.get('type', []))
+            if deptypes and set(deptypes) <= {'test'}:
+                continue
+            if dep.get('hash') in specs:
+                dag[h].add(dep['hash'])
+    return dag
+
+
+def topological_order(dag):
+    """
+    Order the nodes of a DAG so dependencies come first.
+
+    Args:
+        dag (dict): {node: set of dependency nodes}
+    Returns:
+        list: nodes
+    """
+    remaining = {node: set(deps) for node, deps in dag.items()}
+    dependents = {node: set() for node in dag}
+    for node, deps in dag.items():
+        for d in deps:
+            dependents[d].add(node)
+    ready = sorted(node for node, deps in remaining.items() if not deps)
+    order = []
+    while ready:
+        node = ready.pop()
+        order.append(node)
+        for d in sorted(dependents[node]):
+            remaining[d].discard(node)
+            if not remaining[d]:
+                ready.append(d)
+    if len(order) != len(dag):
+        raise Exception('dependency cycle detected')
+    return order
+
+
+def critical_path(dag, weights):
+    """
+    Find the longest weighted path through a DAG.
+
+    Args:
+        dag (dict): {node: set of dependency nodes}
+        weights (dict): {node: seconds}
+    Returns:
+        tuple: ({node: earliest finish time}, [critical path nodes, dependencies first])
+    """
+    finish = {}
+    prev = {}
+    for node in topological_order(dag):
+        start = 0
+        prev[node] = None
+        for d in dag[node]:
+            if finish[d] > start:
+                start = finish[d]
+                prev[node] = d
+        finish[node] = start + weights.get(node, 0)
+    path = []
+    node = max(finish, key=finish.get) if finish else None
+    while node is not None:
+        path.append(node)
+        node = prev[node]
+    return finish, path[::-1]
+
+
+def get_dependents(dag):
+    """
+    Get all transitive dependents of each node in a DAG.
+
+    Args:
+        dag (dict): {node: set of dependency nodes}
+    Returns:
+        dict: {node: set of dependent nodes}
+    """
+    dependents = {node: set() for node in dag}
+    for node in topological_order(dag)[::-1]:
+        for d in dag[node]:
+            dependents[d].add(node)
+            dependents[d] |= dependents[node]
+    return dependents
+
+
+def read_install_times(prefix):
+    """
+    Get the build time spack recorded for an install prefix.
+
+    Args:
+        prefix (str): install prefix
+    Returns:
+        tuple: (seconds, finish timestamp), or (None, None) if unavailable
+    """
+    path = os.path.join(prefix, '.spack', 'install_times.json')
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        return float(data['total']['seconds']), os.path.getmtime(path)
+    except Exception:
+        return None, None
+
+
+def analyze_install(specs, prefixes, since=None):
+    """
+    Analyze per-package build times of an environment.
+
+    Builds the dependency DAG from the concrete specs, and finds the
+    critical path.  Packages on the critical path that take a large part of
+    it serialize the build: everything downstream waits on them, no matter
+    how many packages can otherwise build in parallel.
+
+    Args:
+        specs (dict): {hash: spec node dict}, as from `read_spack_lock`
+        prefixes (dict): {hash: install prefix}
+        since (float): start time of the install, to mark packages built by this run
+    Returns:
+        dict: analysis results
+    """
+    dag = get_dependency_dag(specs)
+    seconds = {}
+    built = set()
+    for h in specs:
+        if h not in prefixes:
+            continue
+        t, finished = read_install_times(prefixes[h])
+        if t is None:
+            continue
+        seconds[h] = t
+        if since and finished >= since:
+            built.add(h)
+    finish, path = critical_path(dag, seconds)
+    path_seconds = finish[path[-1]] if path else 0
+    total = sum(seconds.values())
+    dependents = get_dependents(dag)
+
+    packages = []
+    for h in sorted(seconds, key=seconds.get, reverse=True):
+        share = seconds[h]/total if total else 0
+        on_path = h in path
+        packages.append({
+            'name': specs[h]['name'],
+            'version': specs[h]['version'],
+            'hash': h,
+            'seconds': round(seconds[h], 3),
+            'share': round(share, 4),
+            'built': h in built,
+            'critical': on_path,
+            'dependents': len(dependents[h]),
+            'serializes': on_path and bool(dependents[h]) and path_seconds > 0 and seconds[h] >= 0.05*path_seconds,
+        })
+    return {
+        'total_seconds': round(total, 3),
+        'critical_path_seconds': round(path_seconds, 3),
+        'critical_path': [f'{specs[h]["name"]}@{specs[h]["version"]}/{h[:7]}' for h in path if h in seconds],
+        'packages': packages,
+    }
+
+
+def print_install_analysis(analysis, limit=20):
+    """Print a summary of `analyze_install` results"""
+    total = analysis['total_seconds']
+    path_seconds = analysis['critical_path_seconds']
+    myprint(f'install analysis: {len(analysis["packages"])} packages, {format_seconds(total)} total build time, '
+            f'{format_seconds(path_seconds)} critical path')
+    if path_seconds:
+        myprint(f'install analysis: at most {total/path_seconds:.1f} packages can usefully build in parallel')
+    myprint('install analysis: critical path:', ' -> '.join(analysis['critical_path']))
+    for pkg in analysis['packages'][:limit]:
+        flags = []
+        if pkg['serializes']:
+            flags.append(f'SERIALIZES {pkg["dependents"]} dependents')
+        elif pkg['critical']:
+            flags.append('critical path')
+        if not pkg['built']:
+            flags.append('not built this run')
+        myprint(f'  {pkg["name"]+"@"+pkg["version"]:<40} {format_seconds(pkg["seconds"]):>10} {pkg["share"]*100:5.1f}%  {", ".join(flags)}')
+
+
+def scan_view(view_path, prefixes, exclude=('spack', 'metaprojects')):
+    """
+    Find the symlinks in a view, grouped by the install prefix they point into.
+
+    Args:
+        view_path (Path): root of the view
+        prefixes (dict): {install prefix: package label}
+        exclude (iterable): top-level directories to skip
+    Returns:
+        dict: {package label: set of view paths}
+    """
+    links = {}
+    for root, dirs, files in os.walk(view_path):
+        if root == str(view_path):
+            dirs[:] = [d for d in dirs if d not in exclude]
+        for name in dirs+files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                continue
+            target = os.readlink(path)
+            while target and target != '/':
+                if target in prefixes:
+                    links.setdefault(prefixes[target], set()).add(path)
+                    break
+                target = os.path.dirname(target)
+    return links
+
+
+def view_summary(view_path, prefixes, before, after):
+    """
+    Print a per-package summary of links created and skipped by a view.
+
+    Args:
+        view_path (Path): root of the view
+        prefixes (dict): {install prefix: package label}
+        before (dict): `scan_view` result before the view was updated
+        after (dict): `scan_view` result after the view was updated
+    """
+    total_created = total_skipped = 0
+    for prefix, label in sorted(prefixes.items(), key=lambda x: x[1]):
+        if label not in after:
+            continue
+        created = len(after[label] - before.get(label, set()))
+        num_files = 0
+        for root, dirs, files in os.walk(prefix):
+            if root == prefix:
+                dirs[:] = [d for d in dirs if d != '.spack']
+            num_files += len(files)
+        skipped = max(0, num_files - len(after[label]))
+        total_created += created
+        total_skipped += skipped
+        if created or skipped:
+            myprint(f'view: {label}: {created} links created, {skipped} skipped')
+    myprint(f'view: {len(after)} packages, {total_created} links created, {total_skipped} skipped')
+
+
+def get_buildcache_hashes(buildcache):
+    """
+    Get the spec hashes stored in a filesystem binary build cache.
+
+    Binary packages are content-addressed by their full spec hash,
+    as in `build_cache/<arch>-<compiler>-<name>-<version>-<hash>.spec.json`.
+
+    Args:
+        buildcache (str): path to the build cache
+    Returns:
+        set: spec hashes
+    """
+    hashes = set()
+    path = os.path.join(buildcache, 'build_cache')
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if '.spec.json' in name:
+                hashes.add(name.split('.spec.json',1)[0].rsplit('-',1)[-1])
+    return hashes
 
 
 def num_cpus():
@@ -174,6 +837,356 @@ def num_cpus():
     return ret
 
 
+def host_memory():
+    """Get the total memory of the host in bytes"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def get_memory_profile(filename):
+    """
+    Get the per-package memory profile for the install scheduler.
+
+    Each line of the file is `<package name> <GB per job> [max jobs]`,
+    with a `default` line for packages that are not listed.
+
+    Args:
+        filename (str): the filename to read from
+    Returns:
+        dict: {package name: (bytes per job, max jobs or None)}
+    """
+    profile = {'default': (2*1024**3, None)}
+    if not os.path.exists(filename):
+        return profile
+    with open(filename) as f:
+        for line in f.read().split('\n'):
+            line = line.split('#',1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            max_jobs = int(parts[2]) if len(parts) > 2 else None
+            profile[parts[0]] = (float(parts[1])*1024**3, max_jobs)
+    return profile
+
+
+class InstallScheduler:
+    """
+    Install concrete specs as a DAG of concurrent `spack install` processes.
+
+    A spec starts once all of its dependencies are installed, with a job
+    count from its memory profile.  The total jobs are capped by the number
+    of cores, and the total memory reserved by running installs is capped
+    by the host memory.
+
+    Args:
+        spack_bin (str): path to the spack executable
+        specs (dict): {hash: spec node dict} to install, as from `read_spack_lock`
+        profile (dict): memory profile, as from `get_memory_profile`
+        cores (int): total cores to use
+        memory (float): total bytes of memory to use
+        spack_args (list): extra spack args, like `-e <env>` to resolve hashes
+        install_args (list): extra `spack install` args
+    """
+    def __init__(self, spack_bin, specs, profile, cores, memory, spack_args=(), install_args=()):
+        self.spack_bin = spack_bin
+        self.specs = {h: spec for h, spec in specs.items() if 'external' not in spec}
+        self.profile = profile
+        self.cores = max(1, cores)
+        self.memory = memory
+        self.spack_args = list(spack_args)
+        self.install_args = list(install_args)
+
+    def _budget(self, name):
+        return self.profile.get(name, self.profile['default'])
+
+    def _label(self, h):
+        return f'{self.specs[h]["name"]}@{self.specs[h]["version"]}/{h[:7]}'
+
+    def run(self):
+        """Install all specs, raising an exception if any fail"""
+        global _child_peak_rss
+        if not self.specs:
+            myprint('install: nothing to install')
+            return
+        dag = get_dependency_dag(self.specs)
+        dependents = get_dependents(dag)
+        waiting = {h: set(deps) for h, deps in dag.items()}
+        running = {}
+        failed = []
+        free_cores = self.cores
+        free_memory = self.memory
+        log_dir = tempfile.mkdtemp(prefix='spack-install-logs-', dir=os.getcwd())
+        myprint(f'install: {len(waiting)} specs, {self.cores} cores, {format_bytes(self.memory)} memory, logs in {log_dir}')
+        try:
+            while waiting or running:
+                # start ready specs, most dependents first
+                ready = sorted((h for h, deps in waiting.items() if not deps),
+                               key=lambda h: (-len(dependents[h]), self.specs[h]['name']))
+                for i, h in enumerate([] if failed else ready):
+                    # share free cores between the ready specs
+                    share = max(1, free_cores // (len(ready)-i))
+                    memory_per_job, max_jobs = self._budget(self.specs[h]['name'])
+                    jobs = min(max_jobs or self.cores, share, free_cores, int(free_memory // max(1, memory_per_job)))
+                    if jobs < 1:
+                        if running:
+                            continue
+                        jobs = 1
+                    log_path = os.path.join(log_dir, f'{self.specs[h]["name"]}-{h[:7]}.log')
+                    cmd = [self.spack_bin]+self.spack_args+['install', '-y', '-v', '--only', 'package',
+                                                          '-j', str(jobs)]+self.install_args+['/'+h]
+                    myprint(f'install: starting {self._label(h)} with {jobs} jobs')
+                    with open(log_path, 'w') as log:
+                        log.write('cmd: '+' '.join(cmd)+'\n')
+                        log.flush()
+                        p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+                    running[h] = (p, jobs, jobs*memory_per_job, log_path, time.time())
+                    free_cores -= jobs
+                    free_memory -= jobs*memory_per_job
+                    del waiting[h]
+
+                if not running:
+                    break
+
+                # wait for any install to finish
+                finished = None
+                while finished is None:
+                    for h, (p, jobs, memory, log_path, start) in running.items():
+                        pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+                        if pid:
+                            p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                            finished = h
+                            break
+                    else:
+                        time.sleep(1)
+                p, jobs, memory, log_path, start = running.pop(finished)
+                free_cores += jobs
+                free_memory += memory
+                peak_rss = rusage.ru_maxrss*1024
+                _child_peak_rss = max(_child_peak_rss, peak_rss)
+                msg = f'{self._label(finished)} in {format_seconds(time.time()-start)}, peak rss {format_bytes(peak_rss)}'
+                if p.returncode:
+                    myprint('install: FAILED', msg, '- log:', log_path)
+                    with open(log_path) as f:
+                        myprint(''.join(f.readlines()[-50:]))
+                    failed.append(self._label(finished))
+                else:
+                    myprint('install: finished', msg)
+                    for deps in waiting.values():
+                        deps.discard(finished)
+        except BaseException:
+            for p, *_ in running.values():
+                p.kill()
+                p.wait()
+            raise
+        if failed or waiting:
+            raise Exception('failed to install: '+', '.join(failed))
+        shutil.rmtree(log_dir)
+
+
+def normalize_name(name):
+    """Normalize a python package name (PEP 503)"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def get_wheels(wheel_dir):
+    """
+    List the wheels in a directory.
+
+    Returns:
+        set: (normalized name, version) tuples
+    """
+    ret = set()
+    for filename in os.listdir(wheel_dir):
+        if filename.endswith('.whl'):
+            parts = filename.split('-')
+            if len(parts) >= 5:
+                ret.add((normalize_name(parts[0]), parts[1].lower()))
+    return ret
+
+
+def get_wheel_dag(pip_report):
+    """
+    Get the dependency DAG from a `pip install --report`.
+
+    Optional dependencies (extras) are ignored.
+
+    Args:
+        pip_report (dict): pip installation report
+    Returns:
+        dict: {normalized name: set of dependency names}
+    """
+    names = {normalize_name(item['metadata']['name']) for item in pip_report['install']}
+    dag = {}
+    for item in pip_report['install']:
+        deps = set()
+        for req in item['metadata'].get('requires_dist', []):
+            if 'extra ==' in req or 'extra==' in req:
+                continue
+            m = re.match(r'[A-Za-z0-9._-]+', req)
+            if m and normalize_name(m.group(0)) in names:
+                deps.add(normalize_name(m.group(0)))
+        dag[normalize_name(item['metadata']['name'])] = deps
+    return dag
+
+
+def get_requirement_names(filename):
+    """Get the normalized package names in a requirements file"""
+    ret = set()
+    with open(filename) as f:
+        for line in f:
+            m = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)', line)
+            if m and not line.strip().startswith('#'):
+                ret.add(normalize_name(m.group(1)))
+    return ret
+
+
+PYPI_URL = 'https://pypi.org/pypi'
+
+
+def get_index_hashes(name, version):
+    """
+    Get the sha256 hashes of every artifact on PyPI for a package version.
+
+    Returns:
+        list: sorted sha256 hex digests, empty if the version is not on PyPI
+    """
+    try:
+        with urllib.request.urlopen(f'{PYPI_URL}/{name}/json', timeout=60) as f:
+            data = json.load(f)
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return []
+        raise
+    files = data.get('releases', {}).get(version, [])
+    return sorted({u['digests']['sha256'] for u in files if u.get('digests', {}).get('sha256')})
+
+
+def get_direct_url(download_info):
+    """Get the pip requirement url for the `download_info` of a direct requirement"""
+    url = download_info['url']
+    vcs_info = download_info.get('vcs_info')
+    if vcs_info:
+        url = f'{vcs_info["vcs"]}+{url}@{vcs_info["commit_id"]}'
+    return url
+
+
+def write_pip_lock(path, req, pip_report, index_hashes=None):
+    """
+    Write a pip lockfile, with artifact hashes, from a `pip install --report`.
+
+    Pinned packages get the hash of every artifact on the index, so
+    the lock verifies on any OS_ARCH.  Direct requirements are written
+    as `name @ url`, with their version in a comment.
+
+    Args:
+        path (Path): lockfile path
+        req (Path): requirements file the lock was resolved from
+        pip_report (dict): pip installation report
+        index_hashes (dict): {normalized name: [sha256]} of index artifacts
+    """
+    if not index_hashes:
+        index_hashes = {}
+    top = get_requirement_names(req)
+    dag = get_wheel_dag(pip_report)
+    dependents = {name: {n for n in dag if name in dag[n]} for name in dag}
+    lines = [f'# This file is generated by build_v2.py --pip-lock from {req.name}', '']
+    for item in sorted(pip_report['install'], key=lambda item: normalize_name(item['metadata']['name'])):
+        name = normalize_name(item['metadata']['name'])
+        version = item['metadata']['version']
+        hashes = item.get('download_info', {}).get('archive_info', {}).get('hashes', {})
+        hashes = [hashes['sha256']] if 'sha256' in hashes else []
+        if item.get('is_direct'):
+            lines.append(f'{name} @ {get_direct_url(item["download_info"])}')
+        else:
+            lines.append(f'{name}=={version}')
+            hashes = index_hashes.get(name) or hashes
+        if hashes:
+            lines[-1] += ' \\'
+            lines.extend(f'    --hash=sha256:{h}'+(' \\' if i < len(hashes)-1 else '') for i, h in enumerate(hashes))
+        if item.get('is_direct'):
+            lines.append(f'    # version {version}')
+        via = (['-r '+req.name] if name in top else []) + sorted(dependents[name])
+        if via:
+            lines.append('    # via '+', '.join(via))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+
+
+def read_pip_lock(path):
+    """
+    Read a pip lockfile.
+
+    Args:
+        path (Path): lockfile path
+    Returns:
+        OrderedDict: {normalized name: {spec, version, hashes, via}}
+    """
+    ret = OrderedDict()
+    entry = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip().rstrip('\\').strip()
+            if not line:
+                continue
+            if line.startswith('# via '):
+                if entry:
+                    entry['via'] = [v.strip() for v in line[6:].split(',') if not v.strip().startswith('-r')]
+            elif line.startswith('# version '):
+                if entry:
+                    entry['version'] = line[10:].strip()
+            elif line.startswith('--hash='):
+                if entry:
+                    entry['hashes'].append(line[7:])
+            elif not line.startswith('#'):
+                if ' @ ' in line:
+                    # direct url, with the version in a comment
+                    name, version = line.split(' @ ', 1)[0], ''
+                else:
+                    name, version = line.split('==', 1)
+                entry = {'spec': line, 'version': version.strip(), 'hashes': [], 'via': []}
+                ret[normalize_name(name.strip())] = entry
+    return ret
+
+
+def get_pip_requirements(version, sroot_name):
+    """
+    Get the pip requirements file for a version, preferring the OS-specific one.
+
+    Args:
+        version (list): version path components
+        sroot_name (str): OS_ARCH
+    Returns:
+        Path: requirements file, or None
+    """
+    path = Path(os.path.abspath(os.path.join(os.path.dirname(__file__), *version)+'-pip'))
+    path_os = path.parent / (path.name + '-' + str(sroot_name))
+    if path_os.is_file():
+        return path_os
+    elif path.is_file():
+        return path
+    return None
+
+
+def get_pip_lock_delta(lock, installed, applied):
+    """
+    Get the difference between a pip lockfile and the installed packages.
+
+    Args:
+        lock (dict): lockfile entries, as from `read_pip_lock`
+        installed (dict): {normalized name: version} of installed packages
+        applied (dict): {normalized name: version} of the previously applied lock
+    Returns:
+        tuple: (set of names to install, including dependents, sorted list of names to remove)
+    """
+    changed = {name for name, entry in lock.items() if installed.get(name) != entry['version']}
+    todo = set()
+    while changed:
+        name = changed.pop()
+        todo.add(name)
+        changed.update(n for n in lock[name]['via'] if n in lock and n not in todo)
+    removed = sorted(name for name in applied if name not in lock and name in installed)
+    return todo, removed
+
+
 def relative_to(path1, path2):
     try:
         path1.relative_to(path2)
@@ -182,8 +1195,251 @@ def relative_to(path1, path2):
     return True
 
 
+def format_seconds(seconds):
+    """Format seconds as h:mm:ss"""
+    if seconds is None:
+        return '-'
+    sign = '-' if seconds < 0 else ''
+    seconds = int(round(abs(seconds)))
+    return f'{sign}{seconds//3600}:{seconds//60%60:02d}:{seconds%60:02d}'
+
+
+def format_bytes(num):
+    """Format bytes with a binary unit"""
+    if num is None:
+        return '-'
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(num) < 1024:
+            return f'{num:.0f}{unit}' if unit == 'B' else f'{num:.1f}{unit}'
+        num /= 1024
+    return f'{num:.1f}TiB'
+
+
+class BuildReport:
+    """
+    Phase-level timing and resource usage of a build, saved as JSON next to the sroot.
+
+    For each phase, records the wall time, the CPU time of child processes,
+    the peak RSS of the largest child, and the total disk writes of the
+    build and its child processes (from the block output counters).  The
+    disk writes cover all files, not only the sroot: build and staging
+    directories, downloads, and caches count too.
+
+    Args:
+        version (str): version being built
+    """
+    def __init__(self, version):
+        self.root = None
+        self.path = None
+        self.previous = None
+        self.data = {
+            'version': version,
+            'start': time.time(),
+            'status': 'running',
+            'phases': OrderedDict(),
+        }
+
+    def set_root(self, root):
+        """Set the sroot, and load the previous report for it"""
+        self.root = Path(root)
+        self.path = self.root.parent / (self.root.name+'.build-report.json')
+        if self.path.exists():
+            try:
+                self.previous = json.loads(self.path.read_text())
+            except Exception:
+                myprint('cannot read previous build report', self.path)
+
+    @staticmethod
+    def _blocks_written(self_rusage, children_rusage):
+        # ru_oublock counts 512-byte blocks
+        return (self_rusage.ru_oublock + children_rusage.ru_oublock) * 512
+
+    @contextmanager
+    def phase(self, name):
+        """Measure a build phase"""
+        global _child_peak_rss
+        _child_peak_rss = 0
+        start_self_rusage = resource.getrusage(resource.RUSAGE_SELF)
+        start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            wall = time.time() - start
+            end_self_rusage = resource.getrusage(resource.RUSAGE_SELF)
+            end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (end_rusage.ru_utime + end_rusage.ru_stime) - (start_rusage.ru_utime + start_rusage.ru_stime)
+            peak_rss = _child_peak_rss
+            if end_rusage.ru_maxrss > start_rusage.ru_maxrss:
+                peak_rss = max(peak_rss, end_rusage.ru_maxrss*1024)
+            written = (self._blocks_written(end_self_rusage, end_rusage)
+                       - self._blocks_written(start_self_rusage, start_rusage))
+            self.data['phases'][name] = {
+                'status': status,
+                'wall': round(wall, 3),
+                'cpu': round(cpu, 3),
+                'peak_rss': peak_rss,
+                'disk_write_bytes': written,
+            }
+            myprint(f'phase {name} {status}: wall {format_seconds(wall)}, cpu {format_seconds(cpu)}, '
+                    f'peak rss {format_bytes(peak_rss)}, disk writes {format_bytes(written)}')
+
+    def skip(self, name):
+        """Record a skipped build phase"""
+        self.data['phases'][name] = {
+            'status': 'skipped',
+            'wall': 0,
+            'cpu': 0,
+            'peak_rss': 0,
+            'disk_write_bytes': 0,
+        }
+
+    def save(self, status):
+        """Write the report as JSON"""
+        self.data['status'] = status
+        self.data['end'] = time.time()
+        self.data['wall'] = round(self.data['end'] - self.data['start'], 3)
+        if 'install_analysis' not in self.data and self.previous and 'install_analysis' in self.previous:
+            # keep the package build times when the install phase did not run
+            self.data['install_analysis'] = self.previous['install_analysis']
+        if not self.path:
+            return
+        tmp_path = self.path.parent / (self.path.name+'.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+        myprint('build report written to', self.path)
+
+    def summary(self):
+        """Print a summary, comparing against the previous report"""
+        prev = self.previous.get('phases', {}) if self.previous else {}
+        myprint(f'build report for {self.data["version"]}: {self.data["status"]}')
+        if self.previous:
+            myprint('compared to previous build from', time.ctime(self.previous.get('start', 0)))
+        myprint(f'{"phase":<12} {"status":<8} {"wall":>10} {"previous":>10} {"change":>10} {"cpu":>10} {"peak rss":>10} {"disk write":>10}')
+        rows = list(self.data['phases'].items()) + [('total', {'status': self.data['status'], 'wall': self.data.get('wall')})]
+        for name, phase in rows:
+            if name == 'total':
+                prev_wall = self.previous.get('wall') if self.previous else None
+            else:
+                prev_wall = prev.get(name, {}).get('wall')
+            change = None if prev_wall is None or phase['wall'] is None else phase['wall'] - prev_wall
+            myprint(f'{name:<12} {phase["status"]:<8} {format_seconds(phase["wall"]):>10} '
+                    f'{format_seconds(prev_wall):>10} {format_seconds(change):>10} '
+                    f'{format_seconds(phase.get("cpu")):>10} {format_bytes(phase.get("peak_rss")):>10} '
+                    f'{format_bytes(phase.get("disk_write_bytes")):>10}')
+
+
+class Checkpoints:
+    """
+    Completed build phases, with the fingerprint of their inputs.
+
+    Args:
+        path (Path): the checkpoint file
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.phases = {}
+        if self.path.exists():
+            try:
+                self.phases = json.loads(self.path.read_text())
+            except Exception:
+                myprint('cannot read checkpoints', self.path)
+
+    def done(self, phase, fingerprint):
+        """Check if a phase completed with the same inputs"""
+        return self.phases.get(phase, {}).get('fingerprint') == fingerprint
+
+    def mark(self, phase, fingerprint):
+        """Record a completed phase"""
+        self.phases[phase] = {'fingerprint': fingerprint, 'time': time.time()}
+        self._save()
+
+    def clear(self, phase):
+        """Remove a phase checkpoint"""
+        if self.phases.pop(phase, None) is not None:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path.parent / (self.path.name+'.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.phases, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def get_template_path(src, version):
+    """
+    Get the sroot template for a version.
+
+    Args:
+        src (Path): base source path
+        version (list): version path components
+    Returns:
+        Path: template directory
+    """
+    if version[0] == 'iceprod':
+        return src / 'iceprod' / 'all'
+    elif '.' in version[0] and not src.joinpath(*version).exists():
+        return src.joinpath(version[0].split('.')[0], *version[1:])
+    return src.joinpath(*version)
+
+
+def get_env_fingerprint(version, repo_path, spack_tag, spack_target, compiler_package):
+    """
+    Fingerprint the inputs to concretization.
+
+    Covers the package list, the custom repo, the spack tag,
+    the target, and the compiler package.
+    """
+    digest = hashlib.sha256()
+    with open(os.path.join(os.path.dirname(__file__), *version), 'rb') as f:
+        digest.update(f.read())
+    hash_tree(repo_path, digest)
+    for value in (spack_tag, spack_target, compiler_package):
+        digest.update(b'\0'+str(value).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    """Get the sha256 of a file, or an empty string if it does not exist"""
+    if not os.path.isfile(path):
+        return ''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_compiler_packages(version):
+    """
+    Get the compiler packages for a version, from the `-compiler` file.
+
+    Args:
+        version (list): version path components
+    Returns:
+        tuple: (compiler name, compiler package, all packages), or (None, '', {}) if there is no compiler file
+    """
+    path = os.path.join(os.path.dirname(__file__), *version)+'-compiler'
+    if not os.path.exists(path):
+        myprint('skipping compiler install, as', path, 'is missing')
+        return None, '', {}
+    packages = get_packages(path)
+    compiler_name = None
+    compiler_package = ''
+    for name, package in packages.items():
+        if 'gcc' in name or 'llvm' in name:
+            compiler_name = name
+            compiler_package = package.split()[0]
+    if not compiler_package:
+        raise Exception('could not find compiler package name')
+    return compiler_name, compiler_package, packages
+
+
 class Build:
-    def __init__(self, src, dest, version, mirror=None, spack_tag=None, spack_target=None, compiler_target=None):
+    def __init__(self, src, dest, version, mirror=None, spack_tag=None, spack_target=None, compiler_target=None, buildcache=None, wheelhouse=None, pip_lock=False, report=False, resume=False):
         myprint('building version', version)
         if 'PYTHONPATH' in os.environ:
             del os.environ['PYTHONPATH']
@@ -198,24 +1454,108 @@ class Build:
         self.spack_target = spack_target if spack_target else 'x86_64_v2'
         self.compiler_target = compiler_target if compiler_target else self.spack_target
         os.environ['ARCH'] = self.spack_target
+        self.resume = resume
 
-        sroot_arch = self.spack_target
-        if self.version[0] == 'iceprod':
-            sroot_arch = None
+        self.report = BuildReport(version)
+        status = 'failed'
+        try:
+            self.setup_sroot()
+            self.checkpoints = Checkpoints(self.sroot / '.build-checkpoints.json')
+            self._fingerprint = ''
+
+            self.query = SpackQuery(self.spack_bin)
+            self.fileMirror = Mirror(mirror, spack_bin=self.spack_bin)
+            self.buildcache = os.path.abspath(buildcache) if buildcache else None
+            self.wheelhouse = os.path.abspath(wheelhouse) if wheelhouse else None
+            self.pip_lock = pip_lock
+            self.compiler_name, self.compiler_package, self.compiler_packages = get_compiler_packages(self.version)
+            self.packages = get_packages(os.path.join(os.path.dirname(__file__), *self.version))
+            self.env_name = self.sroot.name.replace('.','_')
+            self.env_path = self.spack_path / 'var' / 'spack' / 'environments' / self.env_name
+            self.lock_path = self.env_path / 'spack.lock'
+            base_path = os.path.join(os.path.dirname(__file__), *self.version)
+
+            template_digest = hashlib.sha256()
+            hash_tree(self.template_path, template_digest)
+            hash_tree(self.repo_path, template_digest)
+            self.run_phase('copy', self.setup_copy, template_digest.hexdigest(), self.spack_tag, self.spack_path.is_dir())
+            self.run_phase('configure', lambda: self.setup_spack(mirror), mirror, self.buildcache)
+            self.run_phase('compiler', self.setup_compiler, hash_file(base_path+'-compiler'), self.compiler_target)
+            self.run_phase('concretize', self.setup_env, self.env_fingerprint())
+            self.run_phase('mirror', self.setup_mirror, hash_file(self.lock_path), mirror)
+            self.run_phase('install', self.setup_install, hash_file(self.lock_path), hash_file(base_path+'-memory'))
+            self.run_phase('view', self.setup_view)
+            self.run_phase('pip', self.setup_python, hash_file(base_path+'-pip'),
+                           hash_file(base_path+'-pip-'+self.sroot.name), hash_file(base_path+'-pip.lock'),
+                           hash_file(base_path+'-pip-'+self.sroot.name+'.lock'), self.pip_lock)
+            self.run_phase('i3_data', self.setup_i3_data, self.dest)
+            status = 'ok'
+        finally:
+            self.report.save(status)
+            if report:
+                self.report.summary()
 
+    def run_phase(self, name, func, *inputs):
+        """
+        Run a build phase, and record a checkpoint when it completes.
+
+        The fingerprint of each phase also covers all earlier phases,
+        so a change in inputs re-runs every phase after it.  In resume
+        mode, a phase is skipped if its fingerprint matches the checkpoint.
+
+        Args:
+            name (str): phase name
+            func (callable): the phase
+            inputs: values the phase depends on
+        """
+        digest = hashlib.sha256(self._fingerprint.encode('utf-8'))
+        for value in inputs:
+            digest.update(b'\0'+str(value).encode('utf-8'))
+        fingerprint = digest.hexdigest()
+        self._fingerprint = fingerprint
+        if self.resume and self.checkpoints.done(name, fingerprint):
+            myprint('resume: skipping phase', name, '- inputs unchanged')
+            self.report.skip(name)
+            return
+        self.checkpoints.clear(name)
+        with self.report.phase(name):
+            func()
+        self.checkpoints.mark(name, fingerprint)
+
+    @property
+    def spack_arch(self):
+        ret = self.query.arch()
+        return {
+            'platform': ret[0],
+            'platform_os': ret[1],
+            'target': self.spack_target
+        }
+
+    @property
+    def compiler_arch(self):
+        ret = self.query.arch()
+        return {
+            'platform': ret[0],
+            'platform_os': ret[1],
+            'target': self.compiler_target
+        }
+
+    @property
+    def compiler_package_with_arch(self):
+        return f'{self.compiler_package} arch={self.compiler_arch["platform"]}-{self.compiler_arch["platform_os"]}-{self.compiler_arch["target"]}'
+
+    def setup_sroot(self):
+        """Find the sroot, copying the sroot template if it does not exist yet"""
         srootbase = self.dest.joinpath(*self.version)
+        self.template_path = get_template_path(self.src, self.version)
         try:
             sroot = get_sroot(str(srootbase))
         except Exception:
             sroot = None
-        if (not sroot) or sroot == 'RHEL_7_x86_64' or not relative_to(sroot, '/cvmfs'):
-            if self.version[0] == 'iceprod':
-                copy_src(self.src / 'iceprod' / 'all', srootbase)
-            elif '.' in self.version[0] and not self.src.joinpath(*self.version).exists():
-                copy_src(self.src.joinpath(self.version[0].split('.')[0], *self.version[1:]), srootbase)
-            else:
-                copy_src(self.src.joinpath(*self.version), srootbase)
+        self.copy_template = (not sroot) or sroot == 'RHEL_7_x86_64' or not relative_to(sroot, '/cvmfs')
         if not sroot:
+            copy_src(self.template_path, srootbase)
+            self.copy_template = False
             sroot = get_sroot(str(srootbase))
         self.srootbase = srootbase
         self.sroot = sroot
@@ -225,126 +1565,88 @@ class Build:
             shutil.rmtree(self.sroot)
         if not self.sroot.is_dir():
             self.sroot.mkdir(parents=True)
+        self.report.set_root(self.sroot)
+
+        self.spack_path = self.sroot / 'spack'
+        os.environ['SPACK_ROOT'] = str(self.spack_path)
+        self.spack_bin = str(self.spack_path / 'bin' / 'spack')
+        self.repo_path = get_repo_path(self.version)
+        self.icecube_repo_path = self.spack_path / 'var/spack/repos/icecube'
+
+    def setup_copy(self):
+        """Copy the sroot template, spack, and the custom repo"""
+        if self.copy_template:
+            copy_src(self.template_path, self.srootbase)
 
         # set up spack
-        self.spack_path = self.sroot / 'spack'
         if not self.spack_path.is_dir():
             url = 'https://github.com/spack/spack.git'
             run_cmd(['git', 'clone', '--depth', '1', '--branch', self.spack_tag, url, str(self.spack_path)])
 
-        os.environ['SPACK_ROOT'] = str(self.spack_path)
-        self.spack_bin = str(self.spack_path / 'bin' / 'spack')
+        # add custom repo, keeping unchanged files (and spack's repo cache) intact
+        sync_tree(self.repo_path, self.icecube_repo_path, delete=True)
+
+    def setup_spack(self, mirror=None):
+        """Configure spack repos and mirrors"""
+        # query spack state once, up front
+        self.query.snapshot()
 
-        # add custom repo
-        repo_path = os.path.join(os.path.dirname(__file__), *self.version)+'-repo'
-        if (not os.path.exists(repo_path)) and len(self.version) == 2 and '.' in self.version[1]:
-            repo_path = os.path.join(os.path.dirname(__file__), self.version[0], '.'.join(self.version[1].split('.')[:2]))+'-repo'
-        if (not os.path.exists(repo_path)) and len(self.version) > 1:
-            repo_path = os.path.join(os.path.dirname(__file__), self.version[0])+'-repo'
-        if (not os.path.exists(repo_path)) and '.' in self.version[0]:
-            repo_path = os.path.join(os.path.dirname(__file__), '.'.join(self.version[0].split('.')[:2]), *self.version[1:])+'-repo'
-        if (not os.path.exists(repo_path)) and '.' in version[0]:
-            repo_path = os.path.join(os.path.dirname(__file__), self.version[0].split('.')[0], *self.version[1:])+'-repo'
-        if not os.path.exists(repo_path): # last resort
-            repo_path = os.path.join(os.path.dirname(__file__), 'repo')
-        icecube_repo_path = self.spack_path / 'var/spack/repos/icecube'
-        if icecube_repo_path.exists():
-            shutil.rmtree(icecube_repo_path)
-        copy_src(repo_path, icecube_repo_path)
-        ret,out,err = run_cmd_output([self.spack_bin, 'repo', 'list', '--scope', 'site'])
-        if any(line.startswith('repo ') for line in out.split('\n')):
-            run_cmd([self.spack_bin, 'repo', 'rm', '--scope', 'site', 'repo'])
-        run_cmd([self.spack_bin, 'repo', 'add', '--scope', 'site', icecube_repo_path])
+        icecube_repo_path = self.icecube_repo_path
+        repos = self.query.repos()
+        if ('repo', str(icecube_repo_path)) not in repos:
+            if any(namespace == 'repo' for namespace, _ in repos):
+                run_cmd([self.spack_bin, 'repo', 'rm', '--scope', 'site', 'repo'])
+            run_cmd([self.spack_bin, 'repo', 'add', '--scope', 'site', icecube_repo_path])
+            self.query.invalidate('repos')
 
         # add mirror
-        self.fileMirror = Mirror(mirror, spack_bin=self.spack_bin)
         if mirror:
-            ret,out,err = run_cmd_output([self.spack_bin, 'mirror', 'list'])
             # set up mirror
             if mirror.startswith('/'):
                 mirror_path = 'file://'+mirror
-                if mirror_path not in out:
+                if not self.query.has_mirror(mirror_path):
                     run_cmd([self.spack_bin, 'mirror', 'add', 'local_filesystem', mirror_path])
+                    self.query.invalidate('mirrors')
             else:
-                if mirror not in out:
+                if not self.query.has_mirror(mirror):
                     run_cmd([self.spack_bin, 'mirror', 'add', 'remote_server', mirror])
+                    self.query.invalidate('mirrors')
 
-        ret = run_cmd_output([self.spack_bin, 'arch'])[1].split('-')
-        self.spack_arch = {
-            'platform': ret[0],
-            'platform_os': ret[1],
-            'target': self.spack_target
-        }
-        self.compiler_arch = {
-            'platform': ret[0],
-            'platform_os': ret[1],
-            'target': self.compiler_target
-        }
-
-        self.setup_compiler()
-        self.setup_env()
-        self.setup_view()
-        self.setup_python()
-
-        # make I3_DATA symlinks
-        i3_data = self.dest / 'data'
-        for path in ('etc/vomsdir', 'etc/vomses', 'share/certificates', 'share/vomsdir'):
-            basedir = self.sroot / os.path.dirname(path)
-            if not basedir.exists():
-                basedir.mkdir(parents=True)
-            link = self.sroot / path
-            if not os.path.lexists(link):
-                (self.sroot / path).symlink_to(i3_data / 'voms' / path)
+        # add binary build cache
+        if self.buildcache:
+            buildcache_url = 'file://'+self.buildcache
+            if not self.query.has_mirror(buildcache_url):
+                run_cmd([self.spack_bin, 'mirror', 'add', '--scope', 'site', 'local_buildcache', buildcache_url])
+                self.query.invalidate('mirrors')
 
     def setup_compiler(self):
         # find system compiler first
-        run_cmd([self.spack_bin, 'compiler', 'find', '--scope=site'])
+        if not self.query.has_compilers(self.compiler_arch['platform_os']):
+            run_cmd([self.spack_bin, 'compiler', 'find', '--scope=site'])
+            self.query.invalidate('compilers')
 
         # setup compiler
-        compiler_package = ''
-        path = os.path.join(os.path.dirname(__file__), *self.version)+'-compiler'
-        if not os.path.exists(path):
-            myprint('skipping compiler install, as', path, 'is missing')
+        if not self.compiler_package:
+            return
+        if self.query.find(self.compiler_name, arch=self.compiler_arch):
+            myprint('compiler', self.compiler_name, 'already installed')
         else:
-            packages = get_packages(path)
-            compiler_name = None
-            for name, package in packages.items():
-                if 'gcc' in name or 'llvm' in name:
-                    compiler_name = name
-                    compiler_package = package.split()[0]
-            if not compiler_package:
-                raise Exception('could not find compiler package name')
-            
-            cmd = [self.spack_bin, 'find', '--json']
-            for pkg in json.loads(run_cmd_output(cmd)[1]):
-                if pkg['name'] == compiler_name and pkg['arch'] == self.compiler_arch:
-                    myprint('compiler', compiler_name, 'already installed')
-                    break
-            else:
-                cmd = [self.spack_bin, 'install', '-y', '-v', '--no-checksum', '-j', str(num_cpus())]
-                for name, package in packages.items():
+            cmd = [self.spack_bin, 'install', '-y', '-v', '--no-checksum', '-j', str(num_cpus())]
+            if self.buildcache:
+                cmd.append('--no-check-signature')
+            try:
+                for name, package in self.compiler_packages.items():
                     myprint('installing', name)
                     self.fileMirror.download(package)
                     run_cmd(cmd+package.split()+['target='+self.compiler_target])
-        self.compiler_package = compiler_package
+            finally:
+                self.query.invalidate('installed')
+                self.push_buildcache()
 
         # add compiler to spack's list of compilers
-        if compiler_package:
-            self.compiler_package_with_arch = f'{compiler_package} arch={self.compiler_arch["platform"]}-{self.compiler_arch["platform_os"]}-{self.compiler_arch["target"]}'
-
-            cmd = [self.spack_bin, 'compiler', 'list']
-            needs_install = True
-            platform_os = ''
-            for line in run_cmd_output(cmd)[1].split('\n'):
-                if line.startswith('--'):
-                    platform_os = line.replace('-', ' ').strip().split()[1]
-                if line.startswith('gcc'):
-                    for comp in line.split():
-                        if comp == compiler_package and platform_os == self.compiler_arch['platform_os']:
-                            needs_install = False
-                            break
-            if needs_install:
-                self._add_compiler(self.compiler_package_with_arch)
+        if not self.query.has_compiler(self.compiler_package, self.compiler_arch['platform_os']):
+            self._add_compiler(self.compiler_package_with_arch)
+            self.query.invalidate('compilers')
 
     def _add_compiler(self, compiler):
         """
@@ -362,9 +1664,25 @@ class Build:
             raise Exception('cannot find compiler '+compiler)
         run_cmd([self.spack_bin, 'compiler', 'add', '--scope', 'site', loc])
 
+    def env_fingerprint(self):
+        """Fingerprint the inputs to concretization"""
+        return get_env_fingerprint(self.version, self.repo_path, self.spack_tag, self.spack_target, self.compiler_package)
+
     def setup_env(self):
-        # create spack env
-        env_name = self.sroot.name.replace('.','_')
+        """Create and concretize the spack environment"""
+        env_name = self.env_name
+        env_path = self.env_path / 'spack.yaml'
+
+        # skip concretization if the inputs have not changed
+        lock_path = self.lock_path
+        fingerprint_path = self.env_path / 'spack.lock.fingerprint'
+        fingerprint = self.env_fingerprint()
+        if lock_path.exists() and fingerprint_path.exists() and fingerprint_path.read_text().strip() == fingerprint:
+            myprint('environment inputs unchanged, reusing', lock_path)
+            return
+        if fingerprint_path.exists():
+            fingerprint_path.unlink()
+
         env_yaml = """# This is a Spack Environment file.
 #
 # It describes a set of packages to be installed, along with
@@ -372,7 +1690,6 @@ class Build:
 spack:
   specs:
 """
-        self.packages = get_packages(os.path.join(os.path.dirname(__file__), *self.version))
         for name, package in self.packages.items():
             if self.spack_target == 'aarch64' and name == 'fftw':
                 # FFTW: libquadmath is not avaliable on ARM
@@ -398,19 +1715,70 @@ spack:
         if self.compiler_package:
             env_yaml += f"""
       compiler:: [{self.compiler_package}]"""
-        env_path = self.spack_path / 'var' / 'spack' / 'environments' / env_name / 'spack.yaml'
         env_path.parent.mkdir(parents=True, exist_ok=True)
         with open(env_path, 'w') as f:
             f.write(env_yaml)
 
-        # now build the env
+        # now concretize the env
         spack_env = str(self.spack_path / 'share' / 'spack' / 'setup-env.sh')
-        cmds = [
+        run_cmd_source_env(spack_env, [
             f'spack env activate {env_name}',
             'spack concretize -f',
-            f'spack install -y -v --fail-fast -j {num_cpus()}',
-        ]
-        run_cmd_source_env(spack_env, cmds)
+        ])
+        fingerprint_path.write_text(fingerprint+'\n')
+
+    def get_install_specs(self):
+        """Get the concrete specs in the environment that are not installed"""
+        installed = {pkg['hash'] for pkg in self.query.installed()}
+        return {h: spec for h, spec in read_spack_lock(self.lock_path).items() if h not in installed}
+
+    def setup_mirror(self):
+        """Fetch missing sources for everything that will be built"""
+        cached = get_buildcache_hashes(self.buildcache) if self.buildcache else set()
+        specs = {h: spec for h, spec in self.get_install_specs().items() if h not in cached}
+        self.fileMirror.prefetch(specs, spack_args=['-e', self.env_name])
+
+    def setup_install(self):
+        """Install the environment"""
+        install_args = ['--no-check-signature'] if self.buildcache else []
+        profile = get_memory_profile(os.path.join(os.path.dirname(__file__), *self.version)+'-memory')
+        scheduler = InstallScheduler(self.spack_bin, self.get_install_specs(), profile,
+                                     cores=num_cpus(), memory=0.9*host_memory(),
+                                     spack_args=['-e', self.env_name], install_args=install_args)
+        install_start = time.time()
+        try:
+            scheduler.run()
+        finally:
+            self.query.invalidate('installed')
+            self.push_buildcache()
+            self.analyze_install(self.lock_path, since=install_start)
+
+    def analyze_install(self, lock_path, since=None):
+        """Analyze per-package build times, and add them to the build report"""
+        try:
+            analysis = analyze_install(read_spack_lock(lock_path), self.query.hash_prefixes(), since=since)
+        except Exception as e:
+            myprint('failed to analyze install', e)
+            return
+        print_install_analysis(analysis)
+        self.report.data['install_analysis'] = analysis
+
+    def push_buildcache(self):
+        """Push all installed specs that are missing from the binary build cache"""
+        if not self.buildcache:
+            return
+        cached = get_buildcache_hashes(self.buildcache)
+        specs = ['/'+pkg['hash'] for pkg in self.query.installed()
+                 if pkg['hash'] not in cached and 'external' not in pkg]
+        if not specs:
+            myprint('build cache is up to date')
+            return
+        myprint('pushing', len(specs), 'specs to build cache')
+        try:
+            run_cmd([self.spack_bin, 'buildcache', 'push', '--unsigned', '--only', 'package', self.buildcache]+specs)
+            run_cmd([self.spack_bin, 'buildcache', 'update-index', self.buildcache])
+        except Exception as e:
+            myprint('failed to push to build cache', e)
 
     def setup_view(self):
         # set up dirs
@@ -419,38 +1787,376 @@ spack:
             if not path.exists():
                 path.mkdir(parents=True)
 
-        # set up view
+        prefixes = self.query.prefixes()
+        before = scan_view(self.sroot, prefixes)
+
+        # set up view, batching all specs into one spack call.
+        # the compiler toolchain is projected without its dependencies.
         if self.compiler_package:
-            run_cmd([self.spack_bin, 'view', '-d', 'false', 'soft', '-i', str(self.sroot), self.compiler_package_with_arch])
-            run_cmd([self.spack_bin, 'view', '-d', 'false', 'soft', '-i', str(self.sroot), 'binutils'])
+            myprint('adding compiler and binutils to view')
+            run_cmd([self.spack_bin, 'view', '-d', 'false', 'soft', '-i', str(self.sroot), self.compiler_package_with_arch, 'binutils'])
             if not os.path.lexists(self.sroot / 'bin' / 'cc'):
                 run_cmd(['ln','-s','gcc','cc'], cwd=(self.sroot / 'bin'))
         cmd = [self.spack_bin, 'view', 'soft', '-i', str(self.sroot)]
         for name, package in self.packages.items():
-            myprint('adding', name, 'to view')
-            view_cmd = cmd+package.split()[:1]
+            spec = package.split()[0]
             if self.compiler_package:
-                view_cmd[-1] += '%'+self.compiler_package
-            view_cmd[-1] += f' arch={self.spack_arch["platform"]}-{self.spack_arch["platform_os"]}-{self.spack_arch["target"]}'
-            run_cmd(view_cmd)
+                spec += '%'+self.compiler_package
+            spec += f' arch={self.spack_arch["platform"]}-{self.spack_arch["platform_os"]}-{self.spack_arch["target"]}'
+            cmd.append(spec)
+        myprint('adding', len(self.packages), 'packages to view')
+        run_cmd(cmd)
+
+        view_summary(self.sroot, prefixes, before, scan_view(self.sroot, prefixes))
+
+    def setup_i3_data(self):
+        """Make I3_DATA symlinks"""
+        i3_data = self.dest / 'data'
+        for path in ('etc/vomsdir', 'etc/vomses', 'share/certificates', 'share/vomsdir'):
+            basedir = self.sroot / os.path.dirname(path)
+            if not basedir.exists():
+                basedir.mkdir(parents=True)
+            link = self.sroot / path
+            if not os.path.lexists(link):
+                (self.sroot / path).symlink_to(i3_data / 'voms' / path)
+
+    def get_wheelhouse(self):
+        """
+        Get the wheel directory for this sroot.
+
+        Wheels are keyed by OS_ARCH and Python ABI, so point releases
+        with the same Python share them.
+        """
+        code,output,error = run_cmd_sroot_output(['python', '-c', '"import sys; print(\'cp%d%d\' % sys.version_info[:2])"'],
+                                                 str(self.srootbase), cwd=self.sroot)
+        abi = output.strip()
+        if code or not abi:
+            raise Exception('cannot get python version: '+error)
+        wheel_dir = Path(self.wheelhouse) / self.sroot.name / abi
+        wheel_dir.mkdir(parents=True, exist_ok=True)
+        return wheel_dir
 
     def setup_python(self):
         # pip install
-        path = Path(os.path.abspath(os.path.join(os.path.dirname(__file__), *self.version)+'-pip'))
-        path_os = path.parent / (path.name + '-' + str(self.sroot.name))
-        if path_os.is_file():
-            myprint('pip install using', path_os.name)
-            cmd = ['python', '-m', 'pip', 'install', '-r', str(path_os)]
-        elif path.is_file():
-            myprint('pip install using', path.name)
-            cmd = ['python', '-m', 'pip', 'install', '-r', str(path)]
-        else:
+        req = get_pip_requirements(self.version, self.sroot.name)
+        if not req:
             myprint('no pip install')
             return
+        myprint('pip install using', req.name)
+        lock_path = req.parent / (req.name+'.lock')
+        with self._wheel_dir() as wheel_dir:
+            if self.pip_lock:
+                self.lock_pip(req, lock_path, wheel_dir)
+            if lock_path.is_file():
+                myprint('pip install using lockfile', lock_path.name)
+                self.install_pip_lock(lock_path, wheel_dir)
+            else:
+                self.install_wheels(req, wheel_dir)
+
+    @contextmanager
+    def _wheel_dir(self):
+        """Get the wheel directory, either the wheelhouse or a temporary one"""
+        if self.wheelhouse:
+            yield str(self.get_wheelhouse())
+        else:
+            with tempfile.TemporaryDirectory(prefix='wheels-', dir=os.getcwd()) as wheel_dir:
+                yield wheel_dir
+
+    def lock_pip(self, req, lock_path, wheel_dir):
+        """
+        Generate a lockfile, with artifact hashes, for a requirements file.
+
+        Args:
+            req (Path): requirements file
+            lock_path (Path): lockfile path
+            wheel_dir (str): wheel directory
+        """
+        # resolve against the index only, so the lock does not depend on local wheels
+        pip_report = self.resolve_requirements(req, wheel_dir, find_links=False)
+        if not pip_report:
+            raise Exception('cannot resolve requirements for '+req.name)
+        pinned = {normalize_name(item['metadata']['name']): item['metadata']['version']
+                  for item in pip_report['install'] if not item.get('is_direct')}
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = {name: pool.submit(get_index_hashes, name, version) for name, version in pinned.items()}
+            index_hashes = {name: f.result() for name, f in futures.items()}
+        write_pip_lock(lock_path, req, pip_report, index_hashes)
+        myprint('wrote', lock_path)
+
+    def install_pip_lock(self, lock_path, wheel_dir):
+        """
+        Install only the difference between a lockfile and the sroot.
+
+        Packages with a different version than installed are installed,
+        along with everything that depends on them.  Packages that were
+        in the previously applied lock, but not this one, are removed.
+
+        Args:
+            lock_path (Path): lockfile path
+            wheel_dir (str): wheel directory
+        """
+        lock = read_pip_lock(lock_path)
+        applied_path = self.sroot / '.pip-lock-applied.json'
+        applied = json.loads(applied_path.read_text()) if applied_path.exists() else {}
+
+        code,output,error = run_cmd_sroot_output(['python', '-m', 'pip', 'list', '--format', 'json'],
+                                                 str(self.srootbase), cwd=self.sroot)
+        if code:
+            raise Exception('cannot list installed python packages: '+error)
+        installed = {normalize_name(pkg['name']): pkg['version'] for pkg in json.loads(output)}
+
+        todo, removed = get_pip_lock_delta(lock, installed, applied)
+        myprint(f'pip lock: {len(lock)} packages, installing {len(todo)}, removing {len(removed)}')
+
+        if todo:
+            self.fetch_wheels({name: lock[name] for name in todo}, wheel_dir)
+            with tempfile.TemporaryDirectory() as d:
+                todo_path = os.path.join(d, 'requirements.txt')
+                with open(todo_path, 'w') as f:
+                    for name in sorted(todo):
+                        print(f'{name}=={lock[name]["version"]}', file=f)
+                run_cmd_sroot(['python', '-m', 'pip', 'install', '--no-deps', '--force-reinstall', '--no-index',
+                               '--find-links', wheel_dir, '-r', todo_path], str(self.srootbase), cwd=self.sroot)
+        if removed:
+            run_cmd_sroot(['python', '-m', 'pip', 'uninstall', '-y']+removed, str(self.srootbase), cwd=self.sroot)
+        applied_path.write_text(json.dumps({name: entry['version'] for name, entry in lock.items()}, indent=2))
+
+    def fetch_wheels(self, entries, wheel_dir):
+        """
+        Fetch or build wheels for lockfile entries, verifying artifact hashes.
+
+        Args:
+            entries (dict): {name: lockfile entry}
+            wheel_dir (str): wheel directory
+        """
+        existing = get_wheels(wheel_dir)
+        entries = {name: entry for name, entry in entries.items() if (name, entry['version'].lower()) not in existing}
+        dag = {name: {n for n in entries if name in entries[n]['via']} for name in entries}
+
+        def run(name):
+            entry = entries[name]
+            with tempfile.TemporaryDirectory() as d:
+                req_path = os.path.join(d, 'requirements.txt')
+                with open(req_path, 'w') as f:
+                    print(' '.join([entry['spec']]+['--hash='+h for h in entry['hashes']]), file=f)
+                cmd = ['python', '-m', 'pip', 'wheel', '--no-deps', '--wheel-dir', wheel_dir, '-r', req_path]
+                if entry['hashes']:
+                    cmd.append('--require-hashes')
+                run_cmd_sroot(cmd, str(self.srootbase), cwd=self.sroot)
+
+        self._run_levels(run, dag)
+
+    def _run_levels(self, func, dag):
+        """Run func on every node of a DAG in parallel, a dependency level at a time"""
+        levels = {}
+        for name in topological_order(dag):
+            levels[name] = 1+max((levels[d] for d in dag[name]), default=-1)
+        with ThreadPoolExecutor(max_workers=num_cpus()) as pool:
+            for level in range(max(levels.values(), default=-1)+1):
+                futures = [pool.submit(func, name) for name in sorted(levels) if levels[name] == level]
+                for f in futures:
+                    f.result()
+
+    def install_wheels(self, req, wheel_dir):
+        """
+        Install requirements from a wheel directory, building missing wheels first.
+
+        Args:
+            req (Path): requirements file
+            wheel_dir (str): wheel directory
+        """
+        cmd = ['python', '-m', 'pip', 'install', '--no-index', '--find-links', wheel_dir, '-r', str(req)]
+        try:
+            run_cmd_sroot(cmd, str(self.srootbase), cwd=self.sroot)
+            return
+        except subprocess.CalledProcessError:
+            myprint('wheel directory is missing requirements, filling', wheel_dir)
+        self.build_wheels(req, wheel_dir)
         run_cmd_sroot(cmd, str(self.srootbase), cwd=self.sroot)
 
+    def build_wheels(self, req, wheel_dir):
+        """
+        Fill a wheel directory with all requirements, in parallel.
+
+        The requirements are resolved with pip, then binary wheels are
+        downloaded and source distributions are built concurrently,
+        in dependency order.
+
+        Args:
+            req (Path): requirements file
+            wheel_dir (str): wheel directory
+        """
+        pip = ['python', '-m', 'pip']
+        pip_report = self.resolve_requirements(req, wheel_dir)
+        if not pip_report:
+            myprint('cannot resolve requirements, building wheels serially')
+            run_cmd_sroot(pip+['wheel', '--wheel-dir', wheel_dir, '--find-links', wheel_dir, '-r', str(req)],
+                          str(self.srootbase), cwd=self.sroot)
+            return
+
+        existing = get_wheels(wheel_dir)
+        items = {}
+        for item in pip_report['install']:
+            name = normalize_name(item['metadata']['name'])
+            version = item['metadata']['version']
+            if (name, version.lower()) in existing:
+                continue
+            url = item.get('download_info', {}).get('url', '')
+            if item.get('is_direct'):
+                spec = url
+            else:
+                spec = f'{name}=={version}'
+            items[name] = (spec, url.split('#')[0].endswith('.whl'))
+        if not items:
+            return
+        binaries = [spec for spec, is_wheel in items.values() if is_wheel]
+        dag = get_wheel_dag(pip_report)
+        # binary wheels are downloaded first, so only order sources among themselves
+        source_names = {name for name, (spec, is_wheel) in items.items() if not is_wheel}
+        sources = {name: dag[name] & source_names for name in source_names}
+        myprint(f'wheels: downloading {len(binaries)}, building {len(sources)}')
+
+        def run(args):
+            run_cmd_sroot(pip+args, str(self.srootbase), cwd=self.sroot)
+
+        # download binary wheels
+        with ThreadPoolExecutor(max_workers=num_cpus()) as pool:
+            futures = [pool.submit(run, ['download', '--no-deps', '--only-binary', ':all:', '--dest', wheel_dir, spec])
+                       for spec in binaries]
+            for f in futures:
+                f.result()
+
+        # build source distributions, a dependency level at a time
+        self._run_levels(lambda name: run(['wheel', '--no-deps', '--wheel-dir', wheel_dir, '--find-links', wheel_dir, items[name][0]]),
+                         sources)
+
+    def resolve_requirements(self, req, wheel_dir, find_links=True):
+        """
+        Resolve a requirements file with pip, without installing anything.
+
+        Args:
+            req (Path): requirements file
+            wheel_dir (str): wheel directory
+            find_links (bool): also resolve from the wheels in wheel_dir
+        Returns:
+            dict: pip installation report, or None if pip cannot resolve
+        """
+        with tempfile.TemporaryDirectory() as d:
+            report_path = os.path.join(d, 'report.json')
+            cmd = ['python', '-m', 'pip', 'install', '--dry-run', '--ignore-installed', '--quiet',
+                   '--report', report_path, '-r', str(req)]
+            if find_links:
+                cmd += ['--find-links', wheel_dir]
+            try:
+                run_cmd_sroot(cmd, str(self.srootbase), cwd=self.sroot)
+                with open(report_path) as f:
+                    return json.load(f)
+            except Exception:
+                return None
+
+
+class GitCache:
+    """
+    Persistent local bare mirrors of git repositories.
+
+    Each repository is fetched at most once per run, and checkouts
+    clone from the local mirror instead of the network.
+
+    Args:
+        path (str): cache directory
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fetched = set()
+        self.lock = threading.Lock()
+
+    def mirror(self, url):
+        """
+        Get the local mirror of a repository, creating or updating it.
+
+        Args:
+            url (str): repository url
+        Returns:
+            Path: the bare mirror
+        """
+        mirror_path = self.path / re.sub(r'[^A-Za-z0-9._-]+', '_', url.split('://')[-1])
+        with self.lock:
+            if url not in self.fetched:
+                if (mirror_path / 'HEAD').exists():
+                    run_cmd(['git', 'fetch', '--prune', '--tags', 'origin'], cwd=mirror_path)
+                else:
+                    self.path.mkdir(parents=True, exist_ok=True)
+                    run_cmd(['git', 'clone', '--mirror', url, str(mirror_path)])
+                self.fetched.add(url)
+        return mirror_path
+
+    def clone(self, url, dest, tag=None):
+        """
+        Check out a repository from the local mirror.
+
+        Tries a shallow clone of the tag or branch first, then falls
+        back to a full clone.  The origin points at the original url.
+
+        Args:
+            url (str): repository url
+            dest (str): checkout directory
+            tag (str): tag, branch, or commit to check out
+        """
+        try:
+            mirror_path = self.mirror(url)
+        except subprocess.CalledProcessError:
+            myprint('cannot update git cache for', url)
+            run_cmd(['git', 'clone', url, dest])
+            if tag:
+                run_cmd(['git', 'checkout', tag], cwd=dest)
+            return
+
+        if tag:
+            branch = tag[5:] if tag.startswith('tags/') else tag
+            try:
+                run_cmd(['git', 'clone', '--depth', '1', '--branch', branch, 'file://'+str(mirror_path), dest])
+                run_cmd(['git', 'remote', 'set-url', 'origin', url], cwd=dest)
+                return
+            except subprocess.CalledProcessError:
+                myprint('shallow checkout of', tag, 'failed, doing a full clone')
+                if os.path.exists(dest):
+                    shutil.rmtree(dest)
+        run_cmd(['git', 'clone', '--reference', str(mirror_path), '--dissociate', url, dest])
+        if tag:
+            run_cmd(['git', 'checkout', tag], cwd=dest)
+
+
+def get_meta_source(meta_name):
+    """
+    Get the source of a metaproject version.
+
+    Args:
+        meta_name (str): metaproject name/version
+    Returns:
+        tuple: (src_url, tag, trunk), where trunk is True for branches that are always rebuilt
+    """
+    meta,name = meta_name.split('/',1)
+    trunk = False
+    if meta == 'icetray':
+        src_url = 'https://github.com/icecube/icetray.git'
+        if name.startswith('V'):
+            # these are old releases ported to git, and need special tag names
+            name = 'tags/releases/'+name
+        elif not name.startswith('v'):
+            # this is a branch, so always rebuild
+            trunk = True
+    else:
+        if 'RC' in name:
+            src_url = 'http://code.icecube.wisc.edu/svn/meta-projects/%s/candidates/%s'%(meta,name)
+        elif name not in ('trunk', 'stable'):
+            src_url = 'http://code.icecube.wisc.edu/svn/meta-projects/%s/releases/%s'%(meta,name)
+        else:
+            src_url = 'http://code.icecube.wisc.edu/svn/meta-projects/%s/%s'%(meta,name)
+            trunk = True
+    return src_url, name, trunk
+
 
-def meta_download(url, dest, tag=None):
+def meta_download(url, dest, tag=None, git_cache=None):
     """
     Metaproject download of a url to a dest.
     """
@@ -459,8 +2165,11 @@ def meta_download(url, dest, tag=None):
         shutil.rmtree(dest)
 
     if url.endswith('.git'):
-        run_cmd(['git', 'clone', url, dest])
-        run_cmd(['git', 'checkout', tag], cwd=dest)
+        if git_cache:
+            git_cache.clone(url, dest, tag=tag)
+        else:
+            run_cmd(['git', 'clone', url, dest])
+            run_cmd(['git', 'checkout', tag], cwd=dest)
     else:
         run_cmd(['svn', 'co', url, dest, '--username', 'icecube',
                  '--password', 'skua', '--no-auth-cache', '--non-interactive'])
@@ -468,69 +2177,645 @@ def meta_download(url, dest, tag=None):
     if not os.path.exists(dest):
         raise Exception('download failed')
 
-def build_meta(dest, version, checkout=False, spack_target=None):
+class CoreBudget:
+    """
+    A global budget of cores, shared by concurrent builds.
+
+    Args:
+        cores (int): total number of cores
+    """
+    def __init__(self, cores):
+        self.total = cores
+        self.free = cores
+        self.users = 0
+        self.cond = threading.Condition()
+
+    def join(self):
+        """Register a build sharing the budget"""
+        with self.cond:
+            self.users += 1
+
+    def leave(self):
+        """Unregister a build"""
+        with self.cond:
+            self.users -= 1
+
+    def share(self):
+        """Get the fair share of cores for each registered build"""
+        with self.cond:
+            return max(1, self.total // max(1, self.users))
+
+    @contextmanager
+    def use(self, min_cores=1, max_cores=1):
+        """
+        Take cores from the budget, waiting until at least `min_cores` are free.
+
+        Args:
+            min_cores (int): minimum number of cores
+            max_cores (int): maximum number of cores
+        Returns:
+            int: number of cores taken
+        """
+        min_cores = min(min_cores, self.total)
+        with self.cond:
+            while self.free < min_cores:
+                self.cond.wait()
+            cores = max(min_cores, min(self.free, max_cores))
+            self.free -= cores
+        try:
+            yield cores
+        finally:
+            with self.cond:
+                self.free += cores
+                self.cond.notify_all()
+
+
+class CompilerCache:
+    """
+    A ccache compiler cache, shared by metaproject builds.
+
+    The cache is split by OS_ARCH and checks the compiler contents,
+    so different sroot toolchains never share objects.  Paths under
+    `basedir` are made relative, so builds in different directories
+    share cache entries.
+
+    Args:
+        path (str): base cache directory
+        sroot (Path): the sroot, for the OS_ARCH
+        srootbase (str): sroot base dir, for the environment
+        size (str): max cache size, like "20G"
+        basedir (str): base dir of the build directories
+    """
+    def __init__(self, path, sroot, srootbase, size='20G', basedir=None):
+        self.path = Path(path).absolute() / Path(sroot).name
+        self.srootbase = srootbase
+        self.size = size
+        self.env = {
+            'CCACHE_DIR': str(self.path),
+            'CCACHE_COMPILERCHECK': 'content',
+            'CCACHE_BASEDIR': basedir if basedir else os.getcwd(),
+            'CCACHE_NOHASHDIR': 'true',
+        }
+
+    def available(self):
+        """Check if ccache is available in the sroot environment"""
+        code,output,error = run_cmd_sroot_output(['command', '-v', 'ccache'], self.srootbase)
+        return code == 0 and bool(output.strip())
+
+    def start(self):
+        """Set up the environment, cache size, and reset the statistics"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        os.environ.update(self.env)
+        run_cmd_sroot(['ccache', '-M', self.size], self.srootbase)
+        run_cmd_sroot(['ccache', '-z'], self.srootbase)
+
+    def cmake_args(self):
+        return ['-DCMAKE_C_COMPILER_LAUNCHER=ccache', '-DCMAKE_CXX_COMPILER_LAUNCHER=ccache']
+
+    def stats(self):
+        """Print the hit/miss statistics"""
+        run_cmd_sroot(['ccache', '-s'], self.srootbase)
+
+
+def meta_update(url, dest, tag=None, git_cache=None, reset=False):
+    """
+    Metaproject update of an existing checkout, downloading it if needed.
+
+    With `reset`, local changes are discarded, instead of requiring a fast-forward.
+    """
+    if not os.path.exists(dest):
+        meta_download(url, dest, tag=tag, git_cache=git_cache)
+        return
+    print("   updating", dest, "from", url)
+    if url.endswith('.git'):
+        remote = 'origin'
+        if git_cache:
+            try:
+                remote = str(git_cache.mirror(url))
+            except subprocess.CalledProcessError:
+                myprint('cannot update git cache for', url)
+        try:
+            run_cmd(['git', 'fetch', remote, tag], cwd=dest)
+            if reset:
+                run_cmd(['git', 'reset', '--hard', 'FETCH_HEAD'], cwd=dest)
+            else:
+                run_cmd(['git', 'merge', '--ff-only', 'FETCH_HEAD'], cwd=dest)
+        except subprocess.CalledProcessError:
+            myprint('cannot update', dest, '- downloading again')
+            meta_download(url, dest, tag=tag, git_cache=git_cache)
+    else:
+        if reset:
+            run_cmd(['svn', 'revert', '-R', '.'], cwd=dest)
+        run_cmd(['svn', 'up', '--username', 'icecube',
+                 '--password', 'skua', '--no-auth-cache', '--non-interactive'], cwd=dest)
+
+
+def get_revision(path):
+    """Get the git or svn revision of a checkout, or None"""
+    if os.path.isdir(os.path.join(path, '.git')):
+        code,output,error = run_cmd_output(['git', 'rev-parse', 'HEAD'], cwd=path)
+    elif os.path.isdir(os.path.join(path, '.svn')):
+        code,output,error = run_cmd_output(['svn', 'info', '--show-item', 'revision'], cwd=path)
+    else:
+        return None
+    return output.strip() if code == 0 else None
+
+
+def checkout_meta_version(src_url, tag, trunk, src_dir, git_cache=None):
+    """
+    Check out one metaproject version, for the checkout-only mode.
+
+    Releases are only checked out once, while branches are updated.
+
+    Returns:
+        str: new, updated, or unchanged
+    """
+    if not os.path.exists(src_dir):
+        meta_download(src_url, src_dir, tag=tag, git_cache=git_cache)
+        return 'new'
+    if not trunk:
+        return 'unchanged'
+    before = get_revision(src_dir)
+    meta_update(src_url, src_dir, tag=tag, git_cache=git_cache, reset=True)
+    return 'unchanged' if before and get_revision(src_dir) == before else 'updated'
+
+
+def swap_dir(new, dest):
+    """Replace dest with new, using renames so dest is never partially written"""
+    old = dest+'.old'
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    if os.path.exists(dest):
+        os.rename(dest, old)
+    os.rename(new, dest)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+
+# cmake generators, by name
+GENERATORS = {
+    'make': 'Unix Makefiles',
+    'ninja': 'Ninja',
+}
+
+
+def find_generator(srootbase, generator='auto'):
+    """
+    Pick the cmake generator, preferring Ninja if it is in the sroot.
+
+    Args:
+        srootbase (str): sroot base dir, for the environment
+        generator (str): auto, make, or ninja
+    Returns:
+        str: make or ninja
+    """
+    if generator != 'auto':
+        return generator
+    code,output,error = run_cmd_sroot_output(['command', '-v', 'ninja'], srootbase)
+    return 'ninja' if code == 0 and output.strip() else 'make'
+
+
+def get_cmake_generator(build_dir):
+    """Get the generator of an existing cmake build dir, or None"""
+    cache = os.path.join(build_dir, 'CMakeCache.txt')
+    if os.path.exists(cache):
+        with open(cache) as f:
+            for line in f:
+                if line.startswith('CMAKE_GENERATOR:'):
+                    return line.split('=', 1)[1].strip()
+    return None
+
+
+def cmake_configure_args(install_dir, generator='make', unity=False, ccache=None):
+    """Get the cmake configure command for a metaproject, without the source dir"""
+    cmd = ['cmake', shlex.quote('-G'+GENERATORS[generator]),
+           '-DCMAKE_BUILD_TYPE=Release',
+           '-DINSTALL_TOOL_LIBS=OFF',
+           '-DCMAKE_INSTALL_PREFIX='+install_dir]
+    if unity:
+        cmd.append('-DCMAKE_UNITY_BUILD=ON')
+    if ccache:
+        cmd += ccache.cmake_args()
+    return cmd
+
+
+def build_meta_version(meta_name, src_url, tag, work_dir, install_dir, srootbase, budget, git_cache=None, ccache=None,
+                       generator='make', unity=False, log=None):
+    """
+    Build and install one metaproject version.
+
+    Checkout, configure, and install take a single core from the budget,
+    while the make step takes a fair share of the cores.
+
+    With a persistent work dir (for branches), the source is updated
+    in place and rebuilt incrementally, then installed to a staging
+    dir and swapped into place.
+
+    Args:
+        meta_name (str): metaproject name/version
+        src_url (str): source url
+        tag (str): git tag or branch
+        work_dir (str): persistent work dir, for incremental rebuilds (default: temporary)
+        install_dir (str): install prefix
+        srootbase (str): sroot base dir, for the environment
+        budget (CoreBudget): shared core budget
+        git_cache (GitCache): local git mirrors
+        ccache (CompilerCache): compiler cache
+        generator (str): cmake generator, make or ninja
+        unity (bool): unity build
+        log (file): log file for build output (default: stdout)
+    """
+    kwargs = {'stdout': log, 'stderr': subprocess.STDOUT} if log else {}
+    install_dir = os.path.abspath(install_dir)
+    budget.join()
+    incremental = bool(work_dir)
+    if incremental:
+        os.makedirs(work_dir, exist_ok=True)
+    else:
+        work_dir = tempfile.mkdtemp(dir=os.getcwd())
+    # fixed layout inside the work dir, so paths are the same for the compiler cache
+    src_dir = os.path.join(work_dir, 'src')
+    build_dir = os.path.join(work_dir, 'build')
+    os.makedirs(build_dir, exist_ok=True)
+    try:
+        with budget.use(1):
+            if incremental:
+                meta_update(src_url, src_dir, tag=tag, git_cache=git_cache)
+            else:
+                meta_download(src_url, src_dir, tag=tag, git_cache=git_cache)
+
+        with budget.use(1):
+            prev_generator = get_cmake_generator(build_dir)
+            if prev_generator and prev_generator != GENERATORS[generator]:
+                myprint('  ', meta_name, 'switching generator from', prev_generator, '- clearing build dir')
+                shutil.rmtree(build_dir)
+                os.mkdir(build_dir)
+            cmd = cmake_configure_args(install_dir, generator=generator, unity=unity, ccache=ccache)
+            cmd.append(src_dir)
+            run_cmd_sroot(cmd, srootbase, cwd=build_dir, **kwargs)
+
+        with budget.use(1, budget.share()) as cores:
+            myprint('  ', meta_name, 'building with', cores, 'cores')
+            cmd = ['cmake', '--build', '.', '--parallel', str(cores)]
+            run_cmd_sroot(cmd, srootbase, cwd=build_dir, **kwargs)
+
+        with budget.use(1):
+            if incremental:
+                staging_dir = install_dir+'.staging'
+                if os.path.exists(staging_dir):
+                    shutil.rmtree(staging_dir)
+                cmd = ['DESTDIR='+staging_dir, 'cmake', '--build', '.', '--target', 'install']
+                run_cmd_sroot(cmd, srootbase, cwd=build_dir, **kwargs)
+                new_dir = install_dir+'.new'
+                if os.path.exists(new_dir):
+                    shutil.rmtree(new_dir)
+                os.rename(staging_dir+install_dir, new_dir)
+                shutil.rmtree(staging_dir)
+                swap_dir(new_dir, install_dir)
+            else:
+                cmd = ['cmake', '--build', '.', '--target', 'install']
+                run_cmd_sroot(cmd, srootbase, cwd=build_dir, **kwargs)
+    finally:
+        budget.leave()
+        if not incremental:
+            shutil.rmtree(work_dir)
+
+
+def benchmark_meta(meta_name, src_url, tag, install_dir, srootbase, git_cache=None):
+    """
+    Benchmark the cmake generators and unity builds for a metaproject.
+
+    Each configuration does a clean configure and build (without
+    install or compiler cache) of the same source, using all cores.
+    """
+    generators = ['make']
+    if find_generator(srootbase) == 'ninja':
+        generators.append('ninja')
+    configs = [(g, unity) for unity in (False, True) for g in generators]
+    work_dir = tempfile.mkdtemp(dir=os.getcwd())
+    results = []
+    try:
+        src_dir = os.path.join(work_dir, 'src')
+        meta_download(src_url, src_dir, tag=tag, git_cache=git_cache)
+        for generator, unity in configs:
+            build_dir = os.path.join(work_dir, 'build')
+            if os.path.exists(build_dir):
+                shutil.rmtree(build_dir)
+            os.mkdir(build_dir)
+            myprint('benchmarking', meta_name, 'with', generator, 'unity' if unity else '')
+            start = time.time()
+            cmd = cmake_configure_args(install_dir, generator=generator, unity=unity)
+            cmd.append(src_dir)
+            run_cmd_sroot(cmd, srootbase, cwd=build_dir)
+            configure_time = time.time() - start
+            start = time.time()
+            run_cmd_sroot(['cmake', '--build', '.', '--parallel', str(num_cpus())], srootbase, cwd=build_dir)
+            results.append((generator, unity, configure_time, time.time() - start))
+    finally:
+        shutil.rmtree(work_dir)
+        myprint(f'benchmark of {meta_name} with {num_cpus()} cores')
+        myprint(f'{"generator":<10} {"unity":<6} {"configure":>10} {"build":>10} {"total":>10}')
+        for generator, unity, configure_time, build_time in results:
+            myprint(f'{generator:<10} {"yes" if unity else "no":<6} {format_seconds(configure_time):>10} '
+                    f'{format_seconds(build_time):>10} {format_seconds(configure_time+build_time):>10}')
+
+
+def checkout_meta(checkouts, git_cache=None, jobs=None):
+    """
+    Check out metaprojects concurrently, and print a summary.
+
+    Args:
+        checkouts (list): (meta_name, src_url, tag, trunk, src_dir) tuples
+        git_cache (GitCache): local git mirrors
+        jobs (int): number of concurrent checkouts (default: 8)
+    """
+    if not checkouts:
+        return
+    jobs = min(len(checkouts), jobs if jobs else 8)
+    myprint(f'checking out {len(checkouts)} metaprojects, {jobs} at a time')
+    status = OrderedDict()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [(meta_name, pool.submit(checkout_meta_version, *args, git_cache=git_cache))
+                   for meta_name, *args in checkouts]
+        for meta_name, future in futures:
+            try:
+                status[meta_name] = future.result()
+            except Exception as e:
+                myprint('failed to check out', meta_name, e)
+                status[meta_name] = 'failed'
+
+    myprint('checkout summary:')
+    for meta_name, s in status.items():
+        myprint(f'  {meta_name:<30} {s}')
+    counts = {s: list(status.values()).count(s) for s in ('new', 'updated', 'unchanged', 'failed')}
+    myprint(', '.join(f'{n} {s}' for s, n in counts.items()))
+    if counts['failed']:
+        raise Exception('failed to check out metaprojects: '+', '.join(m for m, s in status.items() if s == 'failed'))
+
+
+def build_meta(dest, version, checkout=False, spack_target=None, git_cache=None, jobs=None, ccache=None, ccache_size='20G',
+               generator='auto', unity=False, benchmark=False):
     srootbase = os.path.join(dest, version.replace('-metaproject',''))
     spack_target = spack_target if spack_target else 'x86_64_v2'
     os.environ['ARCH'] = spack_target
     sroot = str(get_sroot(str(srootbase)))
 
     metaprojects = get_packages(os.path.join(os.path.dirname(__file__), version))
+    builds = []
+    checkouts = []
     for meta_name in metaprojects:
         myprint('working on', meta_name)
-        meta,name = meta_name.split('/',1)
 
         install_dir = os.path.join(sroot, 'metaprojects', meta_name)
 
-        trunk = False
-        if meta == 'icetray':
-            src_url = 'https://github.com/icecube/icetray.git'
-            if name.startswith('V'):
-                # these are old releases ported to git, and need special tag names
-                name = 'tags/releases/'+name
-            elif not name.startswith('v'):
-                # this is a branch, so always rebuild
-                trunk = True
-        else:
-            if 'RC' in name:
-                src_url = 'http://code.icecube.wisc.edu/svn/meta-projects/%s/candidates/%s'%(meta,name)
-            elif name not in ('trunk', 'stable'):
-                src_url = 'http://code.icecube.wisc.edu/svn/meta-projects/%s/releases/%s'%(meta,name)
-            else:
-                src_url = 'http://code.icecube.wisc.edu/svn/meta-projects/%s/%s'%(meta,name)
-                trunk = True
+        src_url, name, trunk = get_meta_source(meta_name)
 
+        benchmark_args = (meta_name, src_url, name, install_dir)
         if checkout:
             src_dir = os.path.join(srootbase, 'metaprojects', meta_name)
-            if trunk or not os.path.exists(src_dir):
-                meta_download(src_url, src_dir, tag=name)
-            myprint('   checkout only, so skipping build of', meta_name)
+            checkouts.append((meta_name, src_url, name, trunk, src_dir))
             continue
 
         if (not trunk) and os.path.exists(install_dir):
             myprint('   skipping build of', meta_name, ' - already built')
             continue
 
-        src_dir = tempfile.mkdtemp(dir=os.getcwd())
-        build_dir = tempfile.mkdtemp(dir=os.getcwd())
-        try:
-            meta_download(src_url, src_dir, tag=name)
+        # branches keep their source and build dirs, to rebuild incrementally
+        work_dir = os.path.join(os.getcwd(), 'meta-work', os.path.relpath(sroot, dest), meta_name) if trunk else None
+        builds.append((meta_name, src_url, name, work_dir, install_dir))
 
-            cmd = ['cmake', '-DCMAKE_BUILD_TYPE=Release',
-                   '-DINSTALL_TOOL_LIBS=OFF',
-                   '-DCMAKE_INSTALL_PREFIX='+install_dir,
-                   src_dir]
-            run_cmd_sroot(cmd, srootbase, cwd=build_dir)
+    if checkout:
+        checkout_meta(checkouts, git_cache=git_cache, jobs=jobs)
+        return
 
-            cmd = ['make', '-j', str(num_cpus())]
-            run_cmd_sroot(cmd, srootbase, cwd=build_dir)
+    if benchmark:
+        benchmark_meta(*benchmark_args, srootbase, git_cache=git_cache)
+        return
+
+    if not builds:
+        return
+
+    generator = find_generator(srootbase, generator)
+    compiler_cache = None
+    if ccache:
+        compiler_cache = CompilerCache(ccache, sroot, srootbase, size=ccache_size)
+        if compiler_cache.available():
+            compiler_cache.start()
+        else:
+            myprint('ccache is not available, building without a compiler cache')
+            compiler_cache = None
+
+    # build concurrently, sharing the cores
+    cores = num_cpus()
+    jobs = min(len(builds), jobs if jobs else max(1, cores // 8))
+    budget = CoreBudget(cores)
+    log_dir = tempfile.mkdtemp(prefix='meta-logs-', dir=os.getcwd()) if jobs > 1 else None
+    myprint(f'building {len(builds)} metaprojects, {jobs} at a time, with {cores} cores, using {generator}')
+
+    def run(meta_name, *args):
+        if not log_dir:
+            build_meta_version(meta_name, *args, srootbase, budget, git_cache=git_cache, ccache=compiler_cache,
+                               generator=generator, unity=unity)
+            return
+        log_path = os.path.join(log_dir, meta_name.replace('/', '_')+'.log')
+        myprint('  ', meta_name, 'logging to', log_path)
+        with open(log_path, 'w') as log:
+            try:
+                build_meta_version(meta_name, *args, srootbase, budget, git_cache=git_cache, ccache=compiler_cache,
+                                   generator=generator, unity=unity, log=log)
+            except Exception:
+                log.flush()
+                with open(log_path) as f:
+                    myprint(''.join(f.readlines()[-50:]))
+                raise
+        myprint('  ', meta_name, 'installed')
+
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(run, *build): build[0] for build in builds}
+            for future, meta_name in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    myprint('failed to build', meta_name, e)
+                    errors.append(meta_name)
+    finally:
+        if compiler_cache:
+            compiler_cache.stats()
+    if errors:
+        raise Exception('failed to build metaprojects: '+', '.join(errors))
+    if log_dir:
+        shutil.rmtree(log_dir)
+
+def read_spack_db(spack_path):
+    """
+    Read the installed specs from the spack database, without running spack.
+
+    Args:
+        spack_path (Path): spack root
+    Returns:
+        dict: {hash: spec node dict}
+    """
+    path = Path(spack_path) / 'opt' / 'spack' / '.spack-db' / 'index.json'
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        installs = json.load(f).get('database', {}).get('installs', {})
+    return {h: rec.get('spec', {}) for h, rec in installs.items() if rec.get('installed', True)}
+
+
+def get_site_packages(sroot):
+    """
+    Get the python packages installed in an sroot, from the dist-info metadata.
+
+    Returns:
+        dict: {normalized name: version}
+    """
+    ret = {}
+    for path in Path(sroot).glob('lib/python3*/site-packages/*.dist-info'):
+        name, _, version = path.name[:-len('.dist-info')].partition('-')
+        ret[normalize_name(name)] = version
+    return ret
+
+
+def get_pinned_requirements(filename):
+    """Get the pinned `name==version` requirements in a requirements file"""
+    ret = {}
+    with open(filename) as f:
+        for line in f:
+            m = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*==\s*([^\s;#]+)', line)
+            if m:
+                ret[normalize_name(m.group(1))] = m.group(2)
+    return ret
+
+
+def plan_build(src, dest, version, mirror=None, buildcache=None, spack_tag=None, spack_target=None):
+    """
+    Print what a build would do, without changing anything.
+
+    Reads the spack database, environment lock, build cache, mirror,
+    pip lockfile, and previous build report directly, without running
+    spack or pip.  Costs are estimated from the per-package times of
+    the previous build.
+    """
+    parts = version.split('/') if '/' in version else [version]
+    spack_target = spack_target if spack_target else 'x86_64_v2'
+    os.environ['ARCH'] = spack_target
+    srootbase = Path(dest).joinpath(*parts)
+    try:
+        sroot = get_sroot(str(srootbase))
+    except Exception:
+        sroot = srootbase / get_sroot(str(get_template_path(Path(src), parts))).name
+    myprint(f'plan for {version}, sroot {sroot}')
+    if not sroot.exists():
+        myprint('  sroot does not exist yet')
+
+    # spack
+    spack_path = sroot / 'spack'
+    installed = read_spack_db(spack_path)
+    compiler_name, compiler_package, _ = get_compiler_packages(parts)
+    if compiler_package:
+        compiler_spec = compiler_package.split('@')
+        have = any(spec.get('name') == compiler_spec[0] and (len(compiler_spec) < 2 or spec.get('version') == compiler_spec[1])
+                   for spec in installed.values())
+        myprint(f'  compiler {compiler_package}:', 'installed' if have else 'will be built')
+
+    env_path = spack_path / 'var' / 'spack' / 'environments' / sroot.name.replace('.','_')
+    lock_path = env_path / 'spack.lock'
+    specs = {}
+    if not lock_path.exists():
+        myprint('  environment not concretized yet, so the specs to build are unknown')
+    else:
+        fingerprint = get_env_fingerprint(parts, get_repo_path(parts), spack_tag, spack_target, compiler_package)
+        fingerprint_path = env_path / 'spack.lock.fingerprint'
+        if not (fingerprint_path.exists() and fingerprint_path.read_text().strip() == fingerprint):
+            myprint('  environment inputs changed: it will be concretized again, this plan uses the previous lock')
+        specs = {h: spec for h, spec in read_spack_lock(lock_path).items() if 'external' not in spec}
+    todo = {h: spec for h, spec in specs.items() if h not in installed}
+    cached = get_buildcache_hashes(buildcache) & set(todo) if buildcache else set()
+    compile_specs = {h: spec for h, spec in todo.items() if h not in cached}
+    fetch = set()
+    if mirror and mirror.startswith('/'):
+        source_mirror = Mirror(mirror, spack_bin=str(spack_path / 'bin' / 'spack'))
+        fetch = {h for h, spec in compile_specs.items() if not source_mirror.has_spec(spec)}
+    myprint(f'  spack: {len(specs)} specs, {len(specs)-len(todo)} installed, {len(cached)} from build cache, '
+            f'{len(compile_specs)} to compile' + (f', {len(fetch)} sources to fetch' if mirror else ''))
+
+    # estimate from the previous build
+    history = {}
+    report_path = sroot.parent / (sroot.name+'.build-report.json')
+    if report_path.exists():
+        with open(report_path) as f:
+            for pkg in json.load(f).get('install_analysis', {}).get('packages', []):
+                history[(pkg['name'], pkg['version'])] = pkg['seconds']
+                history.setdefault(pkg['name'], pkg['seconds'])
+    seconds = {}
+    for h, spec in compile_specs.items():
+        t = history.get((spec['name'], spec['version']), history.get(spec['name']))
+        if t is not None:
+            seconds[h] = t
+    for h in sorted(compile_specs, key=lambda h: (-seconds.get(h, -1), compile_specs[h]['name'])):
+        spec = compile_specs[h]
+        notes = ['fetch' if h in fetch else '', format_seconds(seconds[h]) if h in seconds else 'unknown time']
+        myprint(f'    {spec["name"]}@{spec["version"]}/{h[:7]}', ' '.join(n for n in notes if n))
+    if compile_specs:
+        finish, path = critical_path(get_dependency_dag(compile_specs), seconds)
+        path_seconds = finish[path[-1]] if path else 0
+        total = sum(seconds.values())
+        estimate = max(path_seconds, total/num_cpus())
+        myprint(f'  estimated compile time: {format_seconds(estimate)} wall ({format_seconds(total)} total, '
+                f'{format_seconds(path_seconds)} critical path, {num_cpus()} cores), '
+                f'{len(compile_specs)-len(seconds)} packages without history')
+
+    # pip
+    req = get_pip_requirements(parts, sroot.name)
+    if req:
+        site_packages = get_site_packages(sroot)
+        lock_path = req.parent / (req.name+'.lock')
+        if lock_path.is_file():
+            applied_path = sroot / '.pip-lock-applied.json'
+            applied = json.loads(applied_path.read_text()) if applied_path.exists() else {}
+            install, removed = get_pip_lock_delta(read_pip_lock(lock_path), site_packages, applied)
+        else:
+            pins = get_pinned_requirements(req)
+            install = {name for name, v in pins.items() if site_packages.get(name) != v}
+            removed = []
+        myprint(f'  pip ({lock_path.name if lock_path.is_file() else req.name}): '
+                f'{len(install)} to install, {len(removed)} to remove')
+        if install:
+            myprint(textwrap.fill('install: '+', '.join(sorted(install)), width=100, initial_indent='    ', subsequent_indent='      ', break_on_hyphens=False))
+        if removed:
+            myprint(textwrap.fill('remove: '+', '.join(removed), width=100, initial_indent='    ', subsequent_indent='      ', break_on_hyphens=False))
+
+
+def plan_meta(src, dest, version, spack_target=None):
+    """Print which metaprojects a build would build, without changing anything"""
+    base_version = version.replace('-metaproject','')
+    parts = base_version.split('/') if '/' in base_version else [base_version]
+    srootbase = Path(dest).joinpath(*parts)
+    os.environ['ARCH'] = spack_target if spack_target else 'x86_64_v2'
+    try:
+        sroot = get_sroot(str(srootbase))
+    except Exception:
+        sroot = srootbase / get_sroot(str(get_template_path(Path(src), parts))).name
+    myprint(f'plan for {version}, sroot {sroot}')
+    exists = sroot.exists()
+    if not exists:
+        myprint('  sroot does not exist yet')
+    for meta_name in get_packages(os.path.join(os.path.dirname(__file__), version)):
+        src_url, name, trunk = get_meta_source(meta_name)
+        install_dir = sroot / 'metaprojects' / meta_name
+        if not exists:
+            status = 'build'
+        elif trunk:
+            status = 'rebuild (branch)'
+        elif install_dir.exists():
+            status = 'installed'
+        else:
+            status = 'build'
+        myprint(f'  {meta_name:<30} {status}')
 
-            if trunk and os.path.exists(install_dir):
-                shutil.rmtree(install_dir)
-            cmd = ['make', 'install']
-            run_cmd_sroot(cmd, srootbase, cwd=build_dir)
-        finally:
-            shutil.rmtree(build_dir)
-            shutil.rmtree(src_dir)
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
@@ -540,30 +2825,66 @@ if __name__ == '__main__':
     parser.add_argument('--dest', help='base dest path')
     parser.add_argument('--checkout', action='store_true', help='metaproject checkout only')
     parser.add_argument('--mirror', help='mirror location')
+    parser.add_argument('--meta-jobs', type=int, default=None, help='number of metaprojects to build (default: CPUS/8) or check out (default: 8) at the same time')
+    parser.add_argument('--generator', default='auto', choices=['auto']+list(GENERATORS), help='cmake generator for metaproject builds (default: ninja if available)')
+    parser.add_argument('--unity', action='store_true', help='unity build for metaprojects')
+    parser.add_argument('--benchmark', action='store_true', help='benchmark the cmake generators and unity build on the last metaproject, instead of building')
+    parser.add_argument('--ccache', default=None, help='compiler cache directory, for metaproject builds')
+    parser.add_argument('--ccache-size', default='20G', help='max compiler cache size (default: 20G)')
+    parser.add_argument('--git-cache', default=os.path.join(os.getcwd(), 'git-cache'), help='local git mirror directory, for metaproject checkouts')
+    parser.add_argument('--buildcache', default=None, help='local binary build cache directory, shared between builds')
+    parser.add_argument('--wheelhouse', default=None, help='local wheel cache directory, shared between builds')
+    parser.add_argument('--pip-lock', action='store_true', help='generate a lockfile, with hashes, for the pip requirements')
+    parser.add_argument('--plan', action='store_true', help='print what would be built, without changing anything')
+    parser.add_argument('--report', action='store_true', help='print a build report, compared against the previous build')
+    parser.add_argument('--resume', action='store_true', help='skip build phases whose inputs are unchanged since they last completed')
     parser.add_argument('--spack-tag', default=None, help='spack tag')
     parser.add_argument('--spack-target', default=None, help='CPU arch to optimize for. ex: x86_64_v2 or neoverse_v2')
     parser.add_argument('--compiler-target', default=None, help='CPU arch to build compiler (may need to be lower than --spack-target)')
     parser.add_argument('versions', nargs='+', help='cvmfs versions to build')
     args = parser.parse_args()
 
+    git_cache = GitCache(args.git_cache)
     for version in args.versions:
-        if version.endswith('-metaproject'):
+        spack_tag = args.spack_tag
+        if not spack_tag:
+            if version.startswith('py') and float(version.split('-')[1][1:3]) == 4.3:
+                spack_tag = 'v0.20.0'
+            else:
+                spack_tag = 'v0.23.0'
+        if args.plan:
+            if version.endswith('-metaproject'):
+                plan_meta(args.src, args.dest, version, spack_target=args.spack_target)
+            else:
+                plan_build(args.src, args.dest, version,
+                    mirror=args.mirror,
+                    buildcache=args.buildcache,
+                    spack_tag=spack_tag,
+                    spack_target=args.spack_target,
+                )
+        elif version.endswith('-metaproject'):
             build_meta(args.dest, version,
                 checkout=args.checkout,
                 spack_target=args.spack_target,
+                git_cache=git_cache,
+                jobs=args.meta_jobs,
+                ccache=args.ccache,
+                ccache_size=args.ccache_size,
+                generator=args.generator,
+                unity=args.unity,
+                benchmark=args.benchmark,
             )
         #elif float(version.split('-')[1][1:3]) < 4.3:
         #    build_old(args.src, args.dest, version, mirror=args.mirror)
         else:
-            spack_tag = args.spack_tag
-            if not spack_tag:
-                if version.startswith('py') and float(version.split('-')[1][1:3]) == 4.3:
-                    spack_tag = 'v0.20.0'
-                else:
-                    spack_tag = 'v0.23.0'
             Build(args.src, args.dest, version,
                 mirror=args.mirror,
                 spack_tag=spack_tag,
                 spack_target=args.spack_target,
                 compiler_target=args.compiler_target,
+                buildcache=args.buildcache,
+                wheelhouse=args.wheelhouse,
+                pip_lock=args.pip_lock,
+                report=args.report,
+                resume=args.resume,
             )